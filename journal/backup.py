@@ -0,0 +1,216 @@
+"""
+Online backups of the journal db. Snapshots are copied with the SQLite backup API a few pages at a time from a
+separate connection, inside one read transaction. With WAL the read transaction never blocks the app's writes, and it
+pins the copy to a single consistent version of the db, so writes made while it runs don't restart it.
+Every snapshot is integrity checked before it is kept, and only the newest BACKUP_COUNT are kept.
+BackupScheduler takes them on a background thread while the app runs, manage.py has backup, backups and restore
+commands.
+"""
+
+import datetime
+import pathlib
+import sqlite3
+import threading
+import time
+
+import logger
+from config import (BACKUP_COUNT, BACKUP_DIR, BACKUP_INTERVAL, BACKUP_PAGES_PER_STEP, BACKUP_START_DELAY,
+                    BACKUP_STEP_SLEEP, DATABASE_NAME)
+from repository import journal_db_connection, schema_version
+
+# snapshots are named <db name>-<timestamp>.db, the timestamp sorts in time order
+TIMESTAMP_FORMAT = '%Y%m%d-%H%M%S-%f'
+
+
+class BackupError(Exception):
+    """ Raised when a snapshot can't be taken, or fails its integrity check. """
+
+
+class BackupScheduler:
+    """ Takes a snapshot every interval seconds on a background thread. The first one is due start_delay seconds after
+        start, or later if the newest snapshot on disk is recent, so starting the app doesn't compete with a backup. """
+
+    def __init__(self, database_name: str = DATABASE_NAME, backup_dir: str = BACKUP_DIR, keep: int = BACKUP_COUNT,
+                 interval: float = BACKUP_INTERVAL, start_delay: float = BACKUP_START_DELAY):
+        self.logger = logger.journal_logger()
+        self.database_name = database_name
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self.interval = interval
+        self.start_delay = start_delay
+
+        self.condition = threading.Condition()
+        self.requested = False
+        self.closed = False
+        self.last_backup = None
+        self.last_error = None
+
+        self.thread = threading.Thread(target=self._run, name='journal-backup', daemon=True)
+        self.thread.start()
+
+    # takes a snapshot as soon as the thread is free, on top of the schedule
+    def request(self):
+        with self.condition:
+            self.requested = True
+            self.condition.notify_all()
+
+    # stops the thread. A snapshot that is being copied is finished first, unless timeout runs out
+    def close(self, timeout: float = None):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+    def _run(self):
+        due = self._first_due()
+        while True:
+            with self.condition:
+                while not (self.closed or self.requested):
+                    remaining = None if due is None else due - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                if self.closed:
+                    return
+                self.requested = False
+
+            try:
+                self.last_backup = create_backup(self.database_name, self.backup_dir, self.keep)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e
+                self.logger.exception('Scheduled backup failed: %s', e)
+            due = None if self.interval is None else time.monotonic() + self.interval
+
+    # seconds are counted from the newest snapshot on disk, so restarting the app doesn't take one every time
+    def _first_due(self) -> float | None:
+        if self.interval is None:
+            return None
+        backups = list_backups(self.database_name, self.backup_dir)
+        wait = self.start_delay
+        if backups:
+            age = (datetime.datetime.now() - backup_time(backups[0], self.database_name)).total_seconds()
+            wait = max(wait, self.interval - age)
+        return time.monotonic() + wait
+
+
+# returns the snapshots of a db, newest first
+def list_backups(database_name: str = DATABASE_NAME, backup_dir: str = BACKUP_DIR) -> list[pathlib.Path]:
+    directory = pathlib.Path(backup_dir)
+    if not directory.is_dir():
+        return []
+    backups = []
+    for path in directory.glob(f'{pathlib.Path(database_name).stem}-*.db'):
+        try:
+            backup_time(path, database_name)
+        except ValueError:
+            continue
+        backups.append(path)
+    return sorted(backups, reverse=True)
+
+
+# the time a snapshot of the db was taken, from its name
+def backup_time(path, database_name: str = DATABASE_NAME) -> datetime.datetime:
+    timestamp = pathlib.Path(path).stem[len(pathlib.Path(database_name).stem) + 1:]
+    return datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT)
+
+
+# copies the db into a new snapshot, checks it, then drops the oldest snapshots past keep. progress is called with
+# (pages copied, total pages) after every step. Returns the snapshot's path
+def create_backup(database_name: str = DATABASE_NAME, backup_dir: str = BACKUP_DIR, keep: int = BACKUP_COUNT,
+                  progress=None, pages: int = BACKUP_PAGES_PER_STEP, sleep: float = BACKUP_STEP_SLEEP) -> pathlib.Path:
+    log = logger.journal_logger()
+    if not pathlib.Path(database_name).exists():
+        raise BackupError(f'{database_name} does not exist')
+    directory = pathlib.Path(backup_dir)
+    directory.mkdir(parents=True, exist_ok=True)
+    stem = pathlib.Path(database_name).stem
+    path = directory / f'{stem}-{datetime.datetime.now().strftime(TIMESTAMP_FORMAT)}.db'
+    # the copy only gets its real name once it has passed the check, a half written snapshot is never listed
+    partial = path.with_suffix('.db.partial')
+
+    start = time.perf_counter()
+    _copy(database_name, partial, progress, pages, sleep)
+    problems = verify_backup(partial)
+    if problems:
+        partial.unlink(missing_ok=True)
+        raise BackupError(f'Snapshot of {database_name} failed its integrity check: {"; ".join(problems)}')
+    partial.replace(path)
+    log.info('Backed up %s to %s in %.2fs', database_name, path, time.perf_counter() - start)
+
+    if keep is not None:
+        rotate_backups(database_name, backup_dir, keep)
+    return path
+
+
+# copies source into a new db file at target, a few pages per step
+def _copy(source_name, target_name, progress, pages: int, sleep: float):
+    source = journal_db_connection(source_name)
+    target = sqlite3.connect(target_name)
+    try:
+        # the open read transaction pins the copy to one version of the db. Without it, a commit from any other
+        # connection between two steps would start the copy over
+        source.execute('BEGIN')
+        source.execute('SELECT count(*) FROM sqlite_master').fetchall()
+        callback = None
+        if progress is not None:
+            callback = lambda status, remaining, total: progress(total - remaining, total)
+        source.backup(target, pages=pages, progress=callback, sleep=sleep)
+        source.rollback()
+        # a snapshot is a single self contained file
+        target.execute('PRAGMA journal_mode = DELETE')
+    except Exception:
+        target.close()
+        pathlib.Path(target_name).unlink(missing_ok=True)
+        raise
+    finally:
+        source.close()
+    target.close()
+
+
+# checks a snapshot, returns the problems found, an empty list when it's sound
+def verify_backup(path) -> list[str]:
+    if not pathlib.Path(path).is_file():
+        return [f'{path} does not exist']
+    try:
+        connection = sqlite3.connect(f'{pathlib.Path(path).resolve().as_uri()}?mode=ro', uri=True)
+        try:
+            problems = [row[0] for row in connection.execute('PRAGMA integrity_check').fetchall() if row[0] != 'ok']
+            if schema_version(connection) == 0:
+                problems.append('it has no journal schema')
+        finally:
+            connection.close()
+    except sqlite3.DatabaseError as e:
+        problems = [str(e)]
+    return problems
+
+
+# deletes the oldest snapshots so at most keep are left
+def rotate_backups(database_name: str = DATABASE_NAME, backup_dir: str = BACKUP_DIR, keep: int = BACKUP_COUNT):
+    log = logger.journal_logger()
+    for path in list_backups(database_name, backup_dir)[keep:]:
+        path.unlink(missing_ok=True)
+        log.info('Removed old backup %s', path)
+
+
+# replaces the contents of the db with a snapshot. The snapshot is checked first, and the current db is backed up
+# (outside the rotation) so the restore itself can be undone. The app must not have the db open
+def restore_backup(path, database_name: str = DATABASE_NAME, backup_dir: str = BACKUP_DIR) -> pathlib.Path | None:
+    log = logger.journal_logger()
+    problems = verify_backup(path)
+    if problems:
+        raise BackupError(f'{path} can\'t be restored: {"; ".join(problems)}')
+
+    previous = None
+    if pathlib.Path(database_name).exists():
+        previous = create_backup(database_name, backup_dir, keep=None)
+
+    source = sqlite3.connect(path)
+    target = journal_db_connection(database_name)
+    try:
+        source.backup(target)
+    finally:
+        source.close()
+        target.close()
+    log.info('Restored %s from %s, the previous db was saved to %s', database_name, path, previous)
+    return previous
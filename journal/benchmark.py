@@ -0,0 +1,408 @@
+"""
+Benchmarks for the journal hot paths, run against generated journal dbs. Run from the journal folder, for example
+    python3 benchmark.py --scale medium --output results.json
+    python3 benchmark.py --scale medium --compare results.json
+Results are written as JSON, --compare reports the change against an earlier results file.
+"""
+
+import argparse
+import datetime
+import http.client
+import json
+import pathlib
+import platform
+import queue
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import controller
+import logger
+import server
+from config import ENTRIES_TABLE, GOALS_STATE_TABLE, GOALS_TABLE
+from repository import (ConnectionManager, EntriesRepository, GoalsRepository, compress_entry, entry_counts,
+                        query_stats, rebuild_goal_stats)
+
+# (years of daily entries, number of goals, max entry size in bytes)
+SCALES = {
+    'small': (1, 5, 2 * 1024),
+    'medium': (10, 50, 8 * 1024),
+    'large': (30, 200, 32 * 1024),
+}
+
+WORDS = ('today', 'walked', 'the', 'dog', 'and', 'then', 'worked', 'on', 'project', 'felt', 'tired', 'happy', 'rain',
+         'coffee', 'with', 'friends', 'read', 'a', 'book', 'about', 'history', 'ran', 'five', 'kilometres', 'cooked',
+         'dinner', 'slept', 'early', 'meeting', 'went', 'long', 'garden', 'needs', 'water', 'call', 'mum', 'tomorrow')
+
+# a regression is reported when a benchmark's median grows by more than this fraction
+DEFAULT_REGRESSION_THRESHOLD = 0.10
+
+# concurrent clients in the API server load test
+DEFAULT_SERVER_CLIENTS = 200
+
+# runs the app's startup path in a fresh interpreter, everything but the Tk window itself
+STARTUP_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import main, logger, controller, repository, benchmark
+logger.configure_logger(log_file=sys.argv[2])
+manager = repository.ConnectionManager(sys.argv[1])
+app = controller.JournalController(repository.EntriesRepository(manager), repository.GoalsRepository(manager), None,
+                                   ui_class=benchmark.HeadlessUI)
+app.ui.wait_for_month()
+print(time.perf_counter() - start)
+app.close()
+logger.shutdown_logger()
+'''
+
+
+class HeadlessUI:
+    """ Stands in for JournalGUI. Calls handed over by worker threads are queued, like the Tk version, and run by
+        wait_for_month on the benchmark thread. """
+
+    def __init__(self, root, controller):
+        self.controller = controller
+        self.pending_calls = queue.SimpleQueue()
+
+    def call_soon(self, func, *args):
+        self.pending_calls.put((func, args))
+
+    def show_loading(self, month):
+        pass
+
+    def show_month(self, month):
+        pass
+
+    # runs handed over calls until the controller has a loaded month
+    def wait_for_month(self, timeout: float = 60):
+        deadline = time.monotonic() + timeout
+        while self.controller.month_loading:
+            func, args = self.pending_calls.get(timeout=max(deadline - time.monotonic(), 0))
+            func(*args)
+
+
+# random entry text of up to max_size bytes
+def random_entry(rng: random.Random, max_size: int) -> str:
+    size = rng.randint(max_size // 10, max_size)
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+# copies a db with the SQLite backup API, safe while the app has the source open
+def copy_database(source: str, target: str):
+    source_connection = sqlite3.connect(source)
+    target_connection = sqlite3.connect(target)
+    try:
+        source_connection.backup(target_connection)
+    finally:
+        target_connection.close()
+        source_connection.close()
+
+
+# builds a journal db with one entry per day and a state for every goal on every day, ending yesterday
+def generate_journal(path: str, years: int, goal_count: int, entry_size: int, seed: int = 0):
+    rng = random.Random(seed)
+    # opening it through a manager creates the schema, the bulk data is then written directly
+    manager = ConnectionManager(path)
+    connection = manager.connection
+    last_day = datetime.date.today() - datetime.timedelta(days=1)
+    first_day = last_day.replace(year=last_day.year - years)
+    day_count = (last_day - first_day).days + 1
+
+    with manager.lock:
+        connection.executemany(f'INSERT INTO {GOALS_TABLE} (goal_description) VALUES (?)',
+                               [(f'goal {i}',) for i in range(1, goal_count + 1)])
+        for start in range(0, day_count, 365):
+            dates = [(first_day + datetime.timedelta(days=offset)).isoformat()
+                     for offset in range(start, min(start + 365, day_count))]
+            entries = [random_entry(rng, entry_size) for _ in dates]
+            connection.executemany(f'''
+            INSERT INTO {ENTRIES_TABLE} (date, entry, compressed, char_count, word_count) VALUES (?, ?, ?, ?, ?)''',
+                                   [(date, *compress_entry(entry), *entry_counts(entry))
+                                    for date, entry in zip(dates, entries)])
+            connection.executemany(f'INSERT INTO {GOALS_STATE_TABLE} (entry_date, goal_id, state) VALUES (?, ?, ?)',
+                                   [(date, goal_id, rng.random() < 0.6)
+                                    for date in dates for goal_id in range(1, goal_count + 1)])
+            connection.commit()
+        # the triggers keep the day counts, the streaks are worked out once at the end
+        rebuild_goal_stats(connection.cursor())
+        connection.commit()
+    manager.close()
+
+
+# runs func repeat times and returns timing statistics in milliseconds. setup runs before every call, untimed
+def measure(func, repeat: int, setup=None) -> dict:
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timing_stats(timings)
+
+
+# min, median, mean, p95 and max of a list of timings in milliseconds
+def timing_stats(timings: list) -> dict:
+    timings = sorted(timings)
+    return {
+        'runs': len(timings),
+        'min_ms': timings[0],
+        'median_ms': statistics.median(timings),
+        'mean_ms': statistics.fmean(timings),
+        'p95_ms': timings[min(int(len(timings) * 0.95), len(timings) - 1)],
+        'max_ms': timings[-1],
+    }
+
+
+def run_benchmarks(path: str, log_file: str, repeat: int, seed: int = 0,
+                   server_clients: int = DEFAULT_SERVER_CLIENTS) -> dict:
+    rng = random.Random(seed)
+    manager = ConnectionManager(path)
+    entries_repo = EntriesRepository(manager)
+    goals_repo = GoalsRepository(manager)
+    goal_ids = [row[0] for row in goals_repo.get_goals()]
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    oldest = datetime.date.fromisoformat(entries_repo.select(ENTRIES_TABLE, ['MIN(date)'])[0][0])
+
+    def random_date() -> datetime.date:
+        return oldest + datetime.timedelta(days=rng.randint(0, (yesterday - oldest).days))
+
+    results = {}
+    app = controller.JournalController(entries_repo, goals_repo, None, prefetch=False, ui_class=HeadlessUI)
+    app.ui.wait_for_month()
+
+    # a month that isn't cached, built on the calling thread
+    def uncached_month():
+        app.current_date = random_date()
+        app.month_cache.clear()
+    results['controller_load_month'] = measure(app._load_month, repeat, setup=uncached_month)
+
+    # paging through the calendar the way the UI does, with the neighbors prefetched between clicks
+    app.prefetch = True
+    app.current_date = random_date()
+    app.month_cache.clear()
+
+    def page():
+        app.next_month()
+        app.ui.wait_for_month()
+
+    def settle():
+        # the user reads the month before clicking again, which gives the prefetch time to finish
+        with app.pending_lock:
+            futures = list(app.pending.values())
+        for future in futures:
+            future.result()
+    results['controller_month_paging'] = measure(page, repeat, setup=settle)
+    app.close()
+
+    journal_data = controller.JournalData(entries_repo, goals_repo)
+    results['save_or_update_day_data'] = measure(
+        lambda: journal_data.save_or_update_day_data(random_date(), random_entry(rng, 2048),
+                                                     {goal_id: rng.random() < 0.5 for goal_id in goal_ids}),
+        repeat)
+    results['goals_edit_goal_states'] = measure(
+        lambda: goals_repo.edit_goal_states(random_date(), {goal_id: rng.random() < 0.5 for goal_id in goal_ids}),
+        repeat)
+    results['goal_stats'] = measure(journal_data.goal_stats, repeat)
+
+    results['base_select'] = measure(
+        lambda: entries_repo.select(ENTRIES_TABLE, conditions={'date': random_date().isoformat()}), repeat)
+    results['base_insert'] = measure(
+        lambda: goals_repo.insert(GOALS_TABLE, ['goal_description'], [(f'bench goal {rng.random()}',)]), repeat)
+    results['base_update'] = measure(
+        lambda: entries_repo.update(ENTRIES_TABLE, {'date': random_date().isoformat()},
+                                    {'entry': random_entry(rng, 2048), 'compressed': 0}),
+        repeat)
+    manager.close()
+
+    results['cold_startup'] = measure_startup(path, log_file, max(repeat // 10, 3))
+    results['server_reads'] = measure_server(path, server_clients, repeat, seed)
+    return results
+
+
+# load test of the API server, every client sends requests_per_client reads on its own keep-alive connection, all at
+# once. Months are asked for again with If-None-Match once a client has their ETag, the way a polling front end
+# would. The timings are per request, requests_per_second is over the whole run
+def measure_server(path: str, clients: int, requests_per_client: int, seed: int = 0) -> dict:
+    api = server.JournalServer(('127.0.0.1', 0), path)
+    threading.Thread(target=api.serve_forever, name='benchmark-server', daemon=True).start()
+    host, port = api.server_address[:2]
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    # two years of months, so some requests are cached and some are not
+    months = sorted({(yesterday - datetime.timedelta(days=offset)).strftime('%Y-%m') for offset in range(0, 730, 28)})
+    timings = []
+    statuses = {}
+    lock = threading.Lock()
+    ready = threading.Barrier(clients + 1)
+
+    def client(number: int):
+        rng = random.Random(seed * 100003 + number)
+        connection = http.client.HTTPConnection(host, port, timeout=60)
+        etags = {}
+        own_timings = []
+        own_statuses = {}
+        ready.wait()
+        for _ in range(requests_per_client):
+            month = rng.choice(months)
+            headers = {}
+            if rng.random() < 0.7:
+                path = f'/months/{month}'
+                if month in etags:
+                    headers['If-None-Match'] = etags[month]
+            else:
+                path = f'/days/{month}-{rng.randint(1, 28):02d}'
+            start = time.perf_counter()
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            own_timings.append((time.perf_counter() - start) * 1000)
+            own_statuses[response.status] = own_statuses.get(response.status, 0) + 1
+            if response.getheader('ETag'):
+                etags[month] = response.getheader('ETag')
+        connection.close()
+        with lock:
+            timings.extend(own_timings)
+            for status, count in own_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=client, args=(number,)) for number in range(clients)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    api.shutdown()
+    api.server_close()
+
+    result = timing_stats(timings)
+    result['clients'] = clients
+    result['requests_per_second'] = len(timings) / elapsed
+    result['statuses'] = {str(status): count for status, count in sorted(statuses.items())}
+    return result
+
+
+# cold startup in a fresh interpreter. Reports the whole process time, and the time from the first import until the
+# first month is on screen as startup_to_month_ms
+def measure_startup(path: str, log_file: str, repeat: int) -> dict:
+    journal_dir = pathlib.Path(__file__).resolve().parent
+    in_process = []
+
+    def start_app():
+        output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, path, log_file], cwd=journal_dir,
+                                check=True, capture_output=True, text=True).stdout
+        in_process.append(float(output.split()[-1]) * 1000)
+
+    result = measure(start_app, repeat)
+    result['startup_to_month_ms'] = statistics.median(in_process)
+    return result
+
+
+# prints the change of every benchmark against a baseline results file, returns the names that regressed
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+    print(f'{"benchmark":<28} {"baseline ms":>12} {"current ms":>12} {"change":>8}')
+    for name, current in results['benchmarks'].items():
+        previous = baseline['benchmarks'].get(name)
+        if previous is None:
+            print(f'{name:<28} {"-":>12} {current["median_ms"]:>12.3f} {"new":>8}')
+            continue
+        change = (current['median_ms'] - previous['median_ms']) / previous['median_ms']
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f'{name:<28} {previous["median_ms"]:>12.3f} {current["median_ms"]:>12.3f} {change:>+8.1%}{flag}')
+    return regressions
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Benchmark the journal against a generated db')
+    parser.add_argument('--scale', choices=SCALES, default='small', help='preset for years, goals and entry size')
+    parser.add_argument('--years', type=int, help='years of daily entries, overrides the scale')
+    parser.add_argument('--goals', type=int, help='number of goals, overrides the scale')
+    parser.add_argument('--entry-size', type=int, help='max entry size in bytes, overrides the scale')
+    parser.add_argument('--repeat', type=int, default=50, help='runs per benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', help='generate into this db file, or reuse it if it exists. The benchmarks run '
+                                           'on a copy, the file itself is never written to after it is generated')
+    parser.add_argument('--output', help='write the results JSON to this file')
+    parser.add_argument('--compare', help='results JSON to compare against')
+    parser.add_argument('--server-clients', type=int, default=DEFAULT_SERVER_CLIENTS,
+                        help='concurrent clients in the API server load test')
+    parser.add_argument('--query-stats', action='store_true',
+                        help='record per statement stats and add them to the results (slows the run down)')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD,
+                        help='fractional slowdown reported as a regression')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    years, goal_count, entry_size = SCALES[args.scale]
+    years = args.years if args.years is not None else years
+    goal_count = args.goals if args.goals is not None else goal_count
+    entry_size = args.entry_size if args.entry_size is not None else entry_size
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        query_stats.enabled = False
+        log_file = str(pathlib.Path(temp_dir) / 'benchmark.log')
+        logger.configure_logger(log_file=log_file)
+        path = str(pathlib.Path(temp_dir) / 'benchmark.db')
+        source = args.database or path
+        if not pathlib.Path(source).exists():
+            print(f'Generating {years} years, {goal_count} goals, entries up to {entry_size} bytes...')
+            start = time.perf_counter()
+            generate_journal(source, years, goal_count, entry_size, args.seed)
+            print(f'Generated {source} in {time.perf_counter() - start:.1f}s')
+        if source != path:
+            # the write benchmarks overwrite entries and add goals, so they never run on a db that was passed in
+            copy_database(source, path)
+        query_stats.enabled = args.query_stats
+
+        results = {
+            'meta': {
+                'date': datetime.datetime.now().isoformat(timespec='seconds'),
+                'scale': {'years': years, 'goals': goal_count, 'entry_size': entry_size},
+                'repeat': args.repeat,
+                'seed': args.seed,
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'db_size_bytes': pathlib.Path(path).stat().st_size,
+            },
+            'benchmarks': run_benchmarks(path, log_file, args.repeat, args.seed, args.server_clients),
+        }
+        if args.query_stats:
+            results['query_stats'] = query_stats.snapshot()
+            query_stats.enabled = False
+        logger.shutdown_logger()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        pathlib.Path(args.output).write_text(output)
+    else:
+        print(output)
+
+    if args.compare:
+        baseline = json.loads(pathlib.Path(args.compare).read_text())
+        if baseline['meta']['scale'] != results['meta']['scale']:
+            print('Warning: the baseline was run at a different scale', file=sys.stderr)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,93 @@ DATABASE_NAME = 'journal_data.db'
 ENTRIES_TABLE = 'entries'
 GOALS_TABLE = 'goals'
 GOALS_STATE_TABLE = 'goals_state'
+ENTRIES_FTS_TABLE = 'entries_fts'
+GOAL_STATS_TABLE = 'goal_stats'
+GOAL_STATS_MONTHLY_TABLE = 'goal_stats_monthly'
+ENTRY_REVISIONS_TABLE = 'entry_revisions'
+ENTRIES_TEXT_VIEW = 'entries_text'
+
+# journals section
+JOURNALS_DIR = 'journals' # every journal is its own db file in here, <journal name>.db
+JOURNAL_IDLE_SECONDS = 10 * 60 # journals that haven't been used for this long have their connection closed
+JOURNAL_NAME_PATTERN = r'[A-Za-z0-9_-]{1,64}' # names become file names, so only letters, digits, - and _
+
+# DB connection tuning, applied to every connection the connection manager opens
+DB_JOURNAL_MODE = 'WAL'
+DB_SYNCHRONOUS = 'NORMAL' # safe with WAL, commits no longer fsync the db file
+DB_CACHE_SIZE = -16384 # negative values are KiB, so roughly 16MB of page cache per connection
+DB_MMAP_SIZE = 256 * 1024 * 1024
+DB_TEMP_STORE = 'MEMORY'
+DB_STATEMENT_CACHE_SIZE = 256
+
+# month cache section
+MONTH_CACHE_SIZE = 12 # number of fully populated months kept in memory
+MONTH_PREFETCH = True # load the previous and next months in the background
+ENTRY_CACHE_SIZE = 16 # number of entry texts kept in memory, months only hold their counts
+
+# query instrumentation section
+QUERY_STATS_ENABLED = False # time every statement the repositories run
+QUERY_SLOW_MS = 50 # statements slower than this are logged with their query plan, while stats are enabled
+QUERY_STATS_SAMPLES = 1000 # latest timings kept per statement for the percentiles
+QUERY_STATS_FILE = 'logs/query_stats.json' # written on exit while stats are enabled
+LOG_VALUE_MAX_LENGTH = 80 # longer strings are cut short in the repository debug logs
+
+# write-behind section
+WRITE_FLUSH_INTERVAL = 1.0 # seconds a queued save may wait before it is written
+WRITE_BATCH_SIZE = 50 # number of pending days that triggers an immediate write
+
+# search section
+SEARCH_HIGHLIGHT = ('[', ']') # markers placed around matched words in search snippets
+SEARCH_SNIPPET_TOKENS = 16 # max number of words in a search snippet
+SEARCH_PAGE_SIZE = 20
+
+# entry compression section
+ENTRY_COMPRESSION = True # store long entries zlib compressed, reads and search see the plain text either way
+ENTRY_COMPRESS_MIN_CHARS = 1024 # entries shorter than this are always stored as plain text
+ENTRY_COMPRESS_LEVEL = 6
+ENTRY_RECOMPRESS_BATCH = 200 # entries converted per transaction by the background recompression job
+ENTRY_RECOMPRESS_PAUSE = 0.05 # seconds between recompression batches
+
+# revision history section
+REVISIONS_ENABLED = True # keep earlier versions of every entry
+REVISION_SNAPSHOT_INTERVAL = 20 # every entry's history stores a full copy at least this often, the rest as deltas
+REVISION_MERGE_SECONDS = 10 * 60 # texts replaced this soon after the last revision aren't kept, autosaves don't pile up
+REVISION_COMPACT_AFTER_DAYS = 30 # compaction keeps only the last revision of each day for revisions older than this
+
+# import/export section
+TRANSFER_PAGE_SIZE = 1000 # rows read per query by exports
+TRANSFER_CHUNK_SIZE = 1000 # days written per transaction by imports
+
+# backup section
+BACKUP_DIR = 'backups'
+BACKUP_COUNT = 7 # number of snapshots kept, the oldest are removed
+BACKUP_INTERVAL = 24 * 60 * 60 # seconds between scheduled snapshots while the app runs, None turns them off
+BACKUP_START_DELAY = 5 * 60 # seconds after start before a snapshot that is already due is taken
+BACKUP_PAGES_PER_STEP = 256 # db pages copied per backup step
+BACKUP_STEP_SLEEP = 0.005 # seconds between backup steps, leaves the disk to the app
+
+# API server section
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8765
+SERVER_POOL_SIZE = 8 # read connections shared by the request threads
+SERVER_POOL_TIMEOUT = 5.0 # seconds a request waits for a free read connection before it gets a 503
+SERVER_BACKLOG = 512 # connections the OS holds until the server accepts them
+SERVER_MONTH_CACHE_SIZE = 240 # encoded month responses kept with their ETags
+SERVER_MAX_BODY_BYTES = 1024 * 1024
+SERVER_WRITE_TIMEOUT = 10.0 # seconds a write request waits for its day to be committed
+SERVER_MAX_SEARCH_LIMIT = 100 # most search results one request can ask for
 
 # logging section
 LOGGING_FILE_NAME = 'logs/journal_app.log'
 LOGGING_MAX_LOG_SIZE = 5 * 1024 * 1024
 LOGGING_FILE_BACKUP_COUNT = 5
 LOGGING_LEVEL = 'DEBUG'
+LOGGING_QUEUE = True # write log records on a background thread instead of the caller's
+LOGGING_JSON = False # write JSON lines instead of plain text
+LOGGING_MAX_MESSAGE_LENGTH = 1000 # longer messages are cut short, None keeps them whole
 
 # UI section
 WINDOW_SIZE = (500,600,150,150) # (size x, size y, location x, location y)
-WINDOW_RESIZEABLE = (False,False)
\ No newline at end of file
+WINDOW_RESIZEABLE = (False,False)
+UI_POLL_INTERVAL_MS = 20 # how often the Tk thread picks up results from background workers
+STARTUP_PAINT_BUDGET_MS = 250 # the empty window should be on screen within this long of main.py starting
@@ -1,11 +1,103 @@
 import calendar
 import datetime
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from dateutil.relativedelta import relativedelta
-
+import logger
 import model
-from gui import JournalGUI
+from config import ENTRY_CACHE_SIZE, MONTH_CACHE_SIZE, MONTH_PREFETCH
 from model import Month
+from writer import WriteBehindQueue
+
+
+# returns the date moved by a number of months, the day is clamped to the length of the new month (Jan 31 + 1 month
+# is the last day of February)
+def add_months(date: datetime.date, months: int) -> datetime.date:
+    month_index = date.year * 12 + date.month - 1 + months
+    year, month = divmod(month_index, 12)
+    day = min(date.day, calendar.monthrange(year, month + 1)[1])
+    return datetime.date(year, month + 1, day)
+
+
+class MonthCache:
+    """ Bounded LRU cache of fully populated Month instances, keyed by (year, month). It is shared between the UI thread
+        and the prefetch worker, so every access goes through the lock. """
+
+    def __init__(self, max_size: int = MONTH_CACHE_SIZE):
+        self.max_size = max_size
+        self.months = OrderedDict()
+        self.lock = threading.Lock()
+        # bumped on every invalidation so a prefetch that started before a write can't store stale data
+        self.generation = 0
+
+    # returns the cached month and marks it as most recently used, or None if it isn't cached
+    def get(self, key: tuple) -> Month | None:
+        with self.lock:
+            month = self.months.get(key)
+            if month is not None:
+                self.months.move_to_end(key)
+            return month
+
+    # stores a month, dropping the least recently used ones once the cache is full
+    def put(self, key: tuple, month: Month):
+        with self.lock:
+            self._store(key, month)
+
+    # stores a prefetched month, unless it was loaded by the UI thread or invalidated while the prefetch was running
+    def put_if_current(self, key: tuple, month: Month, generation: int):
+        with self.lock:
+            if generation == self.generation and key not in self.months:
+                self._store(key, month)
+
+    # drops a month so the next request reloads it from the db
+    def invalidate(self, key: tuple):
+        with self.lock:
+            self.generation += 1
+            self.months.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.months.clear()
+
+    def __contains__(self, key: tuple) -> bool:
+        with self.lock:
+            return key in self.months
+
+    def _store(self, key: tuple, month: Month):
+        self.months[key] = month
+        self.months.move_to_end(key)
+        while len(self.months) > self.max_size:
+            self.months.popitem(last=False)
+
+
+class EntryCache:
+    """ Small LRU of entry texts keyed by date, for the days that have been opened. Months only hold entry counts. """
+
+    def __init__(self, max_size: int = ENTRY_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # returns (True, text) when the date is cached, (False, None) when it isn't
+    def get(self, date) -> tuple:
+        with self.lock:
+            if date not in self.entries:
+                return False, None
+            self.entries.move_to_end(date)
+            return True, self.entries[date]
+
+    def put(self, date, text: str):
+        with self.lock:
+            self.entries[date] = text
+            self.entries.move_to_end(date)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
 
 class JournalData:
@@ -15,9 +107,14 @@ class JournalData:
         self.entry_repo = entries_repo
         self.goal_repo = goals_repo
 
-    # get all the data needed for each day in the month. takes a date, and returns a list of dictionaries for the whole month
-    # returns [{date: {entry: entry,goal_id:(description,state)}}]
-    def populate_month_data(self, date: datetime.date) -> list[dict]:
+    # returns a JournalData whose repositories have their own connection, for use on a background thread
+    def worker(self) -> 'JournalData':
+        manager = self.entry_repo.manager.worker()
+        return JournalData(type(self.entry_repo)(manager), type(self.goal_repo)(manager))
+
+    # get all the data needed for each day in the month. takes a date, and returns a dictionary for the whole month
+    # returns {day_num: [entry, {goal_id: (description, state)}]}, days without any data are left out
+    def populate_month_data(self, date: datetime.date) -> dict[int, list]:
         # get the current year and month from the given date then get the first and last days of the current month
         year = date.year
         month = date.month
@@ -25,94 +122,366 @@ class JournalData:
         last_day_cal = calendar.monthrange(year, month)
         last_day = self.format_date_for_repos(datetime.date(year, month, last_day_cal[1]))
 
-        # get the journal entries for the month
-        entries = self.entry_repo.get_monthly_entries(first_day, last_day)
-        goals = self.goal_repo.get_goals()
-        goal_states = self.goal_repo.get_monthly_states(first_day, last_day)
+        return self.entry_repo.get_month_snapshot(first_day, last_day)
 
-        goal_states_and_descriptions = []
+    # goal completion for every goal between two dates, from one query. Returns {goal_id: GoalProgress}
+    def goal_progress(self, first_day: datetime.date, last_day: datetime.date) -> dict:
+        rows = self.goal_repo.get_states_range(self.format_date_for_repos(first_day), self.format_date_for_repos(last_day))
+        goals = {}
+        for goal_id, description, entry_date, state in rows:
+            goal = goals.get(goal_id)
+            if goal is None:
+                goal = goals[goal_id] = (description, [])
+            if entry_date is not None:
+                goal[1].append((entry_date, state))
+        return {goal_id: model.GoalProgress.from_states(goal_id, description, first_day, last_day, states)
+                for goal_id, (description, states) in goals.items()}
 
-        # add the descriptions to the tuples of id and state
-        for goal_state in goal_states:
-            goal_id = goal_state[0]
-            state = goal_state[1]
-            for goal in goals:
-                if goal[0] == goal_id:
-                    goal_states_and_descriptions.append((goal_id, goal[1], state))
+    # goal completion for every goal over a whole year, for the year at a glance view
+    def goal_year(self, year: int) -> dict:
+        return self.goal_progress(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
 
-        return entries, goal_states_and_descriptions
+    # totals and streaks of every goal over its whole history, {goal_id: model.GoalStats}. Read from the rollup tables,
+    # so this costs the same however long the journal is
+    def goal_stats(self, today: datetime.date = None) -> dict:
+        return {row[0]: model.GoalStats(*row[:7], today=today) for row in self.goal_repo.get_goal_stats()}
+
+    # completion ratio of a goal for every month between two dates that has states, {'YYYY-MM': ratio}
+    def goal_monthly_stats(self, goal_id: int, first_day: datetime.date, last_day: datetime.date) -> dict:
+        months = self.goal_repo.get_monthly_goal_stats(goal_id, first_day.strftime('%Y-%m'), last_day.strftime('%Y-%m'))
+        return model.GoalStats.monthly_ratios(months)
 
     # ensure that the dates passed to the repo are in the correct string format
     def format_date_for_repos(self, date) -> str:
         formatted_date = date.isoformat()
         return formatted_date
 
-    # determine if there is an entry, then call the correct method
-    def save_or_update_day_data(self, date, entry: str, goals: list[dict] = None):
-        if self.entry_repo.get_entry(date) is None:
-            self.save_day_data(date, entry, goals)
-        else:
-            self.update_day_data(date, entry, goals)
+    # saves the entry and goal states for a day in one transaction, whether or not the day already has data.
+    # goals is a dictionary of {goal_id: state}
+    def save_or_update_day_data(self, date, entry: str, goals: dict = None):
+        self.save_days_data({date: (entry, goals)})
 
     # saves new day data to tables
-    def save_day_data(self, date, entry: str, goals: list[dict] = None):
-        self.entry_repo.add_entry(date, entry)
+    def save_day_data(self, date, entry: str, goals: dict = None):
+        self.save_days_data({date: (entry, goals)})
 
     # update entries data to tables
-    def update_day_data(self, date, entry: str, goals: list[dict] = None):
-        self.entry_repo.edit_entry(date, entry)
+    def update_day_data(self, date, entry: str, goals: dict = None):
+        self.save_days_data({date: (entry, goals)})
+
+    # saves the goal states for the day, takes a dictionary of {goal_id: state}
+    def save_goal_states(self, date, goals: dict):
+        self.save_days_data({date: (None, goals)})
+
+    # saves many days at once with a single commit. takes {date: (entry, {goal_id: state})}, an entry or goals of None
+    # leaves that part of the day untouched. revisions False doesn't keep the replaced entry texts, for imports
+    def save_days_data(self, days: dict, revisions: bool = True):
+        entries = []
+        goal_states = []
+        for date, (entry, goals) in days.items():
+            formatted_date = self.format_date_for_repos(date)
+            if entry is not None:
+                entries.append((formatted_date, entry))
+            if goals:
+                goal_states.extend((formatted_date, goal_id, state) for goal_id, state in goals.items())
+
+        # both repositories share a connection, so one cursor covers the entries and the goal states
+        with self.entry_repo.cursor() as cursor:
+            if entries:
+                self.entry_repo.upsert_entries(entries, cursor, revisions)
+            if goal_states:
+                self.goal_repo.upsert_goal_states(goal_states, cursor)
 
 
 class JournalController:
     """ This is the main controller. It handles the Month instances and interfaces with the JournalData controller as well as the UI """
 
-    def __init__(self, entries_repo, goals_repo, root):
+    # ui_class defaults to JournalGUI, the benchmarks pass a headless stand in with the same methods. gui is only
+    # imported here, so JournalData can be used where tkinter isn't installed
+    def __init__(self, entries_repo, goals_repo, root, cache_size: int = MONTH_CACHE_SIZE, prefetch: bool = MONTH_PREFETCH,
+                 ui_class=None):
+        if ui_class is None:
+            from gui import JournalGUI as ui_class
+        self.logger = logger.journal_logger()
         self.journal_data = JournalData(entries_repo, goals_repo)
+        self.month_cache = MonthCache(cache_size)
+        self.entry_cache = EntryCache()
+        self.prefetch = prefetch
+        # single worker, so prefetches never compete with each other for the db connection
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='month-prefetch')
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.prefetch_data = None
+        # months the user asked for are loaded on their own worker, so they never queue behind a prefetch
+        self.loader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='month-loader')
+        self.loader_data = None
+        self.load_future = None
+        # bumped on every month request, a load whose token is no longer current has been superseded
+        self.load_token = 0
+        self.month_loading = False
+        # {goal_id: description} of every goal, not just the ones a month has states for. Refreshed by every month load,
+        # so ticking a goal never has to wait on the db
+        self.goal_descriptions = {}
+        # entry saves are written by a background thread with its own connection
+        self.save_error = None
+        self.writer = WriteBehindQueue(self.journal_data.worker(), on_error=self._on_save_error)
+        # writers of journals switched away from, still writing their last saves. close() waits for them
+        self.retired_writers = []
         self.current_date = datetime.date.today()
-        self.month = self._load_month()
-        self.ui = JournalGUI(root, self)
+        # the window is built around an empty month, the data arrives once the first load finishes
+        self.month = model.Month(self.current_date, self._load_entry_text)
+        self.ui = ui_class(root, self)
+        self.request_month()
 
-    # This returns a Month instance using the current date
+    # This returns a Month instance using the current date, loading it on the calling thread if it isn't cached.
+    # A prefetch that is already running for the month is waited on instead of starting a second load
     def _load_month(self) -> Month:
-        month = model.Month(self.current_date)
-        entries, goals = self.journal_data.populate_month_data(self.current_date)
-        month.data_to_days(entries, goals)
+        key = (self.current_date.year, self.current_date.month)
+        month = self.month_cache.get(key)
+        if month is None:
+            with self.pending_lock:
+                future = self.pending.get(key)
+            if future is not None:
+                future.result()
+                month = self.month_cache.get(key)
+        if month is None:
+            month = self._build_month(self.current_date)
+            self.month_cache.put(key, month)
+        self._prefetch_neighbors(self.current_date)
         return month
 
-    # increases currrent dates month by 1, then creates new month instance with new date
+    # shows the month for the current date. A cached month is shown straight away, otherwise the UI gets an empty
+    # month in the loading state and the populated month is delivered once a worker has loaded it
+    def request_month(self):
+        date = self.current_date
+        key = (date.year, date.month)
+        self.load_token += 1
+        token = self.load_token
+        if self.load_future is not None:
+            # only cancels a load that hasn't started yet, one that is running is ignored when it finishes
+            self.load_future.cancel()
+            self.load_future = None
+
+        month = self.month_cache.get(key)
+        if month is not None:
+            self._show_month(month)
+            self._prefetch_neighbors(date)
+            return
+
+        self.month = model.Month(date, self._load_entry_text)
+        self.month_loading = True
+        self.ui.show_loading(self.month)
+
+        with self.pending_lock:
+            future = self.pending.get(key)
+        if future is None:
+            generation = self.month_cache.generation
+            future = self.load_future = self.loader.submit(self._load_requested_month, key, date, token, generation)
+        # done callbacks run on the worker thread, the UI only touches the result on the Tk thread
+        future.add_done_callback(lambda _: self.ui.call_soon(self._deliver_month, key, token))
+
+    # runs on the loader thread
+    def _load_requested_month(self, key: tuple, date: datetime.date, token: int, generation: int):
+        if token != self.load_token:
+            return
+        try:
+            if self.loader_data is None:
+                self.loader_data = self.journal_data.worker()
+            self.month_cache.put_if_current(key, self._build_month(date, self.loader_data), generation)
+        except Exception as e:
+            self.logger.exception('Failed to load month %s: %s', key, e)
+
+    # runs on the Tk thread once a requested month has loaded
+    def _deliver_month(self, key: tuple, token: int):
+        if token != self.load_token:
+            return
+        month = self.month_cache.get(key)
+        if month is None:
+            # the load failed or the month was invalidated while it ran, fall back to loading it here
+            self.logger.warning('Background load of month %s failed, loading it on the UI thread', key)
+            month = self._load_month()
+        else:
+            self._prefetch_neighbors(datetime.date(key[0], key[1], 1))
+        # anything typed while the month was loading went through the write-behind queue
+        self._apply_unsaved(month)
+        self._show_month(month)
+
+    def _show_month(self, month: Month):
+        self.month = month
+        self.month_loading = False
+        self.ui.show_month(month)
+
+    # builds a fully populated Month instance from the db
+    def _build_month(self, date: datetime.date, journal_data: JournalData = None) -> Month:
+        journal_data = journal_data if journal_data is not None else self.journal_data
+        month = model.Month(date, self._load_entry_text)
+        month.data_to_days(journal_data.populate_month_data(date))
+        # the goals table is tiny, replacing the whole dict keeps readers on the Tk thread safe without a lock
+        self.goal_descriptions = dict(journal_data.goal_repo.get_goals())
+        self._apply_unsaved(month)
+        return month
+
+    # saves still waiting in the write-behind queue are newer than what the db returned
+    def _apply_unsaved(self, month: Month):
+        unsaved = self.writer.unsaved(lambda day: (day.year, day.month) == (month.year, month.month_num))
+        for date, (entry, goals) in unsaved.items():
+            if entry is not None:
+                month.get_day(date.day).set_entry(entry)
+            if goals:
+                month.set_day_goals(date.day, self._described_goals(month, goals))
+
+    # fetches an entry text when a day is opened, called by the month through Day.entry
+    def _load_entry_text(self, date: datetime.date) -> str | None:
+        cached, text = self.entry_cache.get(date)
+        if not cached:
+            text = self.journal_data.entry_repo.get_entry_text(date)
+            self.entry_cache.put(date, text)
+        return text
+
+    # loads the previous and next months on the worker thread so paging doesn't wait on the db
+    def _prefetch_neighbors(self, date: datetime.date):
+        if not self.prefetch:
+            return
+        first_day = date.replace(day=1)
+        for neighbor in (add_months(first_day, -1), add_months(first_day, 1)):
+            key = (neighbor.year, neighbor.month)
+            with self.pending_lock:
+                if key in self.pending or key in self.month_cache:
+                    continue
+                generation = self.month_cache.generation
+                self.pending[key] = self.executor.submit(self._prefetch_month, key, neighbor, generation)
+
+    # runs on the worker thread, with its own connection so prefetching never holds the UI thread's connection lock
+    def _prefetch_month(self, key: tuple, date: datetime.date, generation: int):
+        try:
+            if self.prefetch_data is None:
+                self.prefetch_data = self.journal_data.worker()
+            self.month_cache.put_if_current(key, self._build_month(date, self.prefetch_data), generation)
+        except Exception as e:
+            self.logger.exception('Failed to prefetch month %s: %s', key, e)
+        finally:
+            with self.pending_lock:
+                self.pending.pop(key, None)
+
+    # called on the writer thread when a batch of saves fails, the queue keeps the data and retries it
+    def _on_save_error(self, error: Exception, dates: list):
+        self.save_error = (error, dates)
+
+    # writes any queued saves now, returns False if they couldn't be saved
+    def flush(self, timeout: float = None) -> bool:
+        return self.writer.flush(timeout)
+
+    # writes the queued saves and stops the background workers, to be called when the window closes
+    def close(self):
+        self.writer.close()
+        for writer in self.retired_writers:
+            writer.close()
+        self.loader.shutdown(wait=True, cancel_futures=True)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        for journal_data in (self.loader_data, self.prefetch_data):
+            if journal_data is not None:
+                journal_data.entry_repo.manager.close()
+
+    # shows another journal, journal_data usually comes from a JournalRegistry that keeps it open. Nothing here waits on
+    # the old journal: its queued saves are written by its own writer in the background, and nothing loaded from it is
+    # kept
+    def switch_journal(self, journal_data: JournalData):
+        self.writer.close(timeout=0)
+        self.retired_writers = [writer for writer in self.retired_writers if writer.thread.is_alive()]
+        self.retired_writers.append(self.writer)
+        with self.pending_lock:
+            for key, future in list(self.pending.items()):
+                # a cancelled prefetch never runs, so it can't take itself out of pending
+                if future.cancel():
+                    del self.pending[key]
+
+        self.journal_data = journal_data
+        # months still loading from the old journal were loaded under the old generation, so they are never stored
+        self.month_cache.clear()
+        self.entry_cache.clear()
+        self.goal_descriptions = {}
+        self.save_error = None
+        self.writer = WriteBehindQueue(self.journal_data.worker(), on_error=self._on_save_error)
+        # the workers run one task at a time in order, so these run after anything still using the old journal's
+        # connections and before anything loaded from the new one
+        self.loader.submit(self._close_worker_data, 'loader_data')
+        self.executor.submit(self._close_worker_data, 'prefetch_data')
+        self.request_month()
+
+    # runs on a worker thread, closes its connection so the next task opens one to the current journal
+    def _close_worker_data(self, attribute: str):
+        worker_data = getattr(self, attribute)
+        setattr(self, attribute, None)
+        if worker_data is not None:
+            worker_data.entry_repo.manager.close()
+
+    # increases currrent dates month by 1, then shows the new month
     def next_month(self):
-        self.current_date = self.current_date + relativedelta(month=1)
-        self.month = self.load_month()
+        self.current_date = add_months(self.current_date, 1)
+        self.request_month()
 
-    # decreases current date's month by 1, then creates new month instance with new date
+    # decreases current date's month by 1, then shows the new month
     def previous_month(self):
-        self.current_date = self.current_date + relativedelta(month=-1)
-        self.month = self.load_month()
+        self.current_date = add_months(self.current_date, -1)
+        self.request_month()
 
-     # increases current date's day, and creates new month instance if needed
+     # increases current date's day, and shows the new month if needed
     def increase_day(self):
         prev_month_num = self.current_date.month
-        self.current_date = self.current_date + relativedelta(days=1)
+        self.current_date = self.current_date + datetime.timedelta(days=1)
         if prev_month_num != self.current_date.month:
-            self.month = self._load_month()
+            self.request_month()
 
-     # decreases current date's day, and creates new month instance if needed
+     # decreases current date's day, and shows the new month if needed
     def decrease_day(self):
         prev_month_num = self.current_date.month
-        self.current_date = self.current_date + relativedelta(days=-1)
+        self.current_date = self.current_date - datetime.timedelta(days=1)
         if prev_month_num != self.current_date.month:
-            self.month = self._load_month()
+            self.request_month()
 
      # sets the current dates entry
     def add_day_entry(self, entry: str):
         day_num = self.current_date.day
         day = self.month.get_day(day_num)
+        # the cached month holds this same day instance, so the cache is updated in place
         day.set_entry(entry)
-        self.journal_data.save_day_data(self.current_date, day.entry)
-    
+        # a month rebuilt from the db reads the text through the entry cache, so it has to hold the new text too
+        self.entry_cache.put(self.current_date, entry)
+        self.writer.save(self.current_date, entry=day.entry)
+
+    # sets the current dates goal states, takes a dictionary of {goal_id: state}
+    def set_day_goals(self, goals: dict):
+        # goals go through the queue too, so they stay ordered with the entry saves for the same day
+        self.writer.save(self.current_date, goals=goals)
+        # the cached month holds this same instance, so the cache is updated in place. A month that is still loading
+        # picks the states up from the queue when it's delivered
+        self.month.set_day_goals(self.current_date.day, self._described_goals(self.month, goals))
+
+    # {goal_id: state} to {goal_id: (description, state)} for a month. A goal added since the last month load has no
+    # description until the next one
+    def _described_goals(self, month: Month, goals: dict) -> dict:
+        descriptions = self.goal_descriptions
+        return {goal_id: (descriptions.get(goal_id, month.goal_descriptions.get(goal_id)), state)
+                for goal_id, state in goals.items()}
+
+    # the earlier versions of the current dates entry, oldest first, [(revision, created, char_count)]. The text on
+    # screen isn't one of them
+    def get_entry_revisions(self) -> list[tuple]:
+        # queued saves are written first, so the list ends with the text the screen replaced
+        self.writer.flush()
+        return self.journal_data.entry_repo.get_revisions(self.current_date)
+
+    # puts an earlier version of the current dates entry back. It is saved like any edit, the text it replaces becomes
+    # the newest revision
+    def restore_entry_revision(self, revision: int):
+        self.writer.flush()
+        text = self.journal_data.entry_repo.get_revision_text(self.current_date, revision)
+        if text is None:
+            raise ValueError(f'{self.current_date} has no revision {revision}')
+        self.add_day_entry(text)
+
     # gets the current dates entry
     def get_day_entry(self) -> str:
         day_num = self.current_date.day
         day = self.month.get_day(day_num)
         return day.entry
-
@@ -1,15 +1,24 @@
 import controller
+import logger
+import queue
 import tkinter as tk
 from tkinter import ttk
 
+from config import UI_POLL_INTERVAL_MS
 
 
 class JournalGUI():
     def __init__(self,root,controller):
         super().__init__()
         self.controller = controller
+        self.logger = logger.journal_logger()
         self.style_configure()
         self.window = root
+        self.month = None
+        self.loading = False
+        # callables handed over by background threads, run on the Tk thread by _run_pending_calls
+        self.pending_calls = queue.SimpleQueue()
+        self.window.after(UI_POLL_INTERVAL_MS, self._run_pending_calls)
         
 
     # configure styles for windows and widgets
@@ -21,6 +30,35 @@ class JournalGUI():
     def building_frames(self):
         pass
 
+    # thread safe, schedules func(*args) to run on the Tk thread. Tk itself may only be touched from the Tk thread,
+    # so background workers hand their results over through here
+    def call_soon(self, func, *args):
+        self.pending_calls.put((func, args))
+
+    # runs the calls handed over by background threads, then checks again after UI_POLL_INTERVAL_MS. A call that
+    # raises is logged and skipped, so one failure can't stop the polling and with it every later month delivery
+    def _run_pending_calls(self):
+        while True:
+            try:
+                func, args = self.pending_calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                func(*args)
+            except Exception as e:
+                self.logger.exception('Call from a background thread failed: %s', e)
+        self.window.after(UI_POLL_INTERVAL_MS, self._run_pending_calls)
+
+    # shows the month's calendar layout while its data is still loading
+    def show_loading(self, month):
+        self.month = month
+        self.loading = True
+
+    # shows a fully loaded month
+    def show_month(self, month):
+        self.month = month
+        self.loading = False
+
 
 class JournalView():
     def __init__(self,root):
@@ -0,0 +1,236 @@
+"""
+Several journals side by side, each in its own db file under JOURNALS_DIR named <journal name>.db, so every journal
+stays small and is backed up, restored and migrated on its own. JournalRegistry opens a journal's db the first time it
+is used, keeps it open while it's used and closes it on a timer once it has been idle for JOURNAL_IDLE_SECONDS.
+Search and goal statistics can run over several journals at once. The journal files are attached to one connection
+with ATTACH DATABASE and read in place, nothing is copied.
+"""
+
+import datetime
+import pathlib
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import logger
+import model
+from config import (ENTRIES_FTS_TABLE, ENTRIES_TABLE, GOAL_STATS_TABLE, GOALS_TABLE, JOURNAL_IDLE_SECONDS,
+                    JOURNAL_NAME_PATTERN, JOURNALS_DIR, SEARCH_HIGHLIGHT, SEARCH_PAGE_SIZE, SEARCH_SNIPPET_TOKENS)
+from controller import JournalData
+from repository import (ConnectionManager, EntriesRepository, GoalsRepository, fts_keywords_query,
+                        journal_db_connection)
+
+JOURNAL_NAME = re.compile(JOURNAL_NAME_PATTERN)
+# SQLite's default limit on attached dbs, Connection.getlimit to read the actual one only exists from Python 3.11
+DEFAULT_MAX_ATTACHED = 10
+
+
+class JournalError(Exception):
+    """ Raised for a journal name that isn't valid, or a journal that doesn't exist. """
+
+
+class JournalRegistry:
+    """ Hands out one JournalData per journal, whose repositories share a connection manager. A journal's connection
+        is only opened by its first query, and is kept warm until it has been idle for idle_seconds, so switching
+        between journals doesn't reopen or re-check a db each time. Idle journals are closed by a timer thread, except
+        the journal last handed out by journal(), which is the one being shown. Using a closed journal again simply
+        reopens it. """
+
+    def __init__(self, directory: str = JOURNALS_DIR, idle_seconds: float = JOURNAL_IDLE_SECONDS):
+        self.logger = logger.journal_logger()
+        self.directory = pathlib.Path(directory)
+        self.idle_seconds = idle_seconds
+        self.lock = threading.Lock()
+        # {name: [JournalData, last used (time.monotonic()), or None once its connection was closed for being idle]}.
+        # Closed journals stay listed, a JournalData that is still held elsewhere reopens its connection when it's used
+        # again, and close() has to find it then
+        self.journals = {}
+        # the journal last handed out by journal(), never closed for being idle
+        self.current = None
+        # the threading.Timer of the next idle check, only running while there are journals it could close
+        self.timer = None
+
+    # the names of every journal in the directory, sorted
+    def names(self) -> list[str]:
+        if not self.directory.is_dir():
+            return []
+        return sorted(path.stem for path in self.directory.glob('*.db') if JOURNAL_NAME.fullmatch(path.stem))
+
+    # the db file of a journal, whether or not it exists yet
+    def path(self, name: str) -> pathlib.Path:
+        if not JOURNAL_NAME.fullmatch(name):
+            raise JournalError(f'{name!r} is not a valid journal name, use letters, digits, - and _')
+        return self.directory / f'{name}.db'
+
+    # the journal's data, opened on first use. A journal that doesn't exist is created with create, else it's an error
+    def journal(self, name: str, create: bool = False) -> JournalData:
+        with self.lock:
+            self.current = name
+            return self._open(name, create)
+
+    # closes the connections of the journals that haven't been used for max_idle seconds, returns their names
+    def close_idle(self, max_idle: float = None) -> list[str]:
+        with self.lock:
+            return self._close_idle(self.idle_seconds if max_idle is None else max_idle)
+
+    # closes every journal's connection
+    def close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            for journal_data, _ in self.journals.values():
+                journal_data.entry_repo.manager.close()
+            self.journals.clear()
+
+    # called with the lock held
+    def _open(self, name: str, create: bool = False) -> JournalData:
+        path = self.path(name)
+        opened = self.journals.get(name)
+        if opened is None:
+            if not path.exists():
+                if not create:
+                    raise JournalError(f'There is no journal named {name!r} in {self.directory}')
+                self.directory.mkdir(parents=True, exist_ok=True)
+                self.logger.info('Creating journal %s at %s', name, path)
+            manager = ConnectionManager(str(path))
+            opened = self.journals[name] = [JournalData(EntriesRepository(manager), GoalsRepository(manager)), 0]
+        opened[1] = time.monotonic()
+        self._schedule_idle_check()
+        return opened[0]
+
+    # called with the lock held
+    def _close_idle(self, max_idle: float) -> list[str]:
+        now = time.monotonic()
+        closed = []
+        for name, opened in self.journals.items():
+            if name == self.current or opened[1] is None or now - opened[1] < max_idle:
+                continue
+            opened[0].entry_repo.manager.close()
+            opened[1] = None
+            closed.append(name)
+            self.logger.debug('Closed idle journal %s', name)
+        return closed
+
+    # starts the timer for when the next open journal becomes idle, if it isn't running. Called with the lock held
+    def _schedule_idle_check(self):
+        if self.timer is not None:
+            return
+        last_used = [opened[1] for name, opened in self.journals.items()
+                     if name != self.current and opened[1] is not None]
+        if not last_used:
+            return
+        delay = max(min(last_used) + self.idle_seconds - time.monotonic(), 0)
+        self.timer = threading.Timer(delay, self._idle_check)
+        self.timer.daemon = True
+        self.timer.start()
+
+    # runs on the timer thread
+    def _idle_check(self):
+        with self.lock:
+            if self.timer is not threading.current_thread():
+                # close() cancelled this timer while it was firing
+                return
+            self.timer = None
+            self._close_idle(self.idle_seconds)
+            self._schedule_idle_check()
+
+    # full text search over several journals, every journal by default. Returns [(journal, date, snippet, rank)] with
+    # the best matches first, like EntriesRepository.search_entries
+    def search(self, keywords: str, names: list = None, first_day: datetime.date = None,
+               last_day: datetime.date = None, limit: int = SEARCH_PAGE_SIZE, offset: int = 0,
+               raw: bool = False) -> list[tuple]:
+        match = keywords if raw else fts_keywords_query(keywords)
+        if not match:
+            return []
+        where_clause = f'f.{ENTRIES_FTS_TABLE} MATCH ?'
+        values = [*SEARCH_HIGHLIGHT, match]
+        if first_day is not None:
+            where_clause += ' AND e.date >= ?'
+            values.append(first_day.isoformat())
+        if last_day is not None:
+            where_clause += ' AND e.date <= ?'
+            values.append(last_day.isoformat())
+
+        results = []
+        for connection, schemas in self._attached(names):
+            selects = [f'''
+            SELECT {index}, e.date, snippet(f.{ENTRIES_FTS_TABLE}, 0, ?, ?, '...', {SEARCH_SNIPPET_TOKENS}),
+            bm25(f.{ENTRIES_FTS_TABLE})
+            FROM {schema}.{ENTRIES_FTS_TABLE} AS f JOIN {schema}.{ENTRIES_TABLE} AS e ON e.id = f.rowid
+            WHERE {where_clause}''' for index, (schema, _) in enumerate(schemas)]
+            query = ' UNION ALL '.join(selects) + ' ORDER BY 4 LIMIT ?'
+            rows = connection.execute(query, values * len(schemas) + [offset + limit]).fetchall()
+            results.extend((schemas[index][1], date, snippet, rank) for index, date, snippet, rank in rows)
+        # each group of attached journals is already cut to offset + limit, only the merge is left
+        results.sort(key=lambda row: row[3])
+        return results[offset:offset + limit]
+
+    # goal statistics over several journals, every journal by default, with goals matched by description.
+    # Returns {description: model.GoalStats}. Days are added up, the best streak is the best in any one journal and
+    # the current streak the longest one still running in any journal
+    def goal_stats(self, names: list = None, today: datetime.date = None) -> dict:
+        rows = []
+        for connection, schemas in self._attached(names):
+            selects = [f'''
+            SELECT g.goal_description, coalesce(s.tracked_days, 0), coalesce(s.completed_days, 0),
+            coalesce(s.current_streak, 0), s.current_streak_end, coalesce(s.best_streak, 0)
+            FROM {schema}.{GOALS_TABLE} AS g LEFT JOIN {schema}.{GOAL_STATS_TABLE} AS s ON s.goal_id = g.id'''
+                       for schema, _ in schemas]
+            rows.extend(connection.execute(' UNION ALL '.join(selects)).fetchall())
+
+        goals = {}
+        for description, tracked, completed, current, current_end, best in rows:
+            # a current streak that ended before yesterday has already been broken
+            stats = model.GoalStats(None, description, tracked, completed, current, current_end, best, today)
+            total = goals.get(description)
+            if total is None:
+                goals[description] = [tracked, completed, stats.current_streak, current_end, best]
+                continue
+            total[0] += tracked
+            total[1] += completed
+            if stats.current_streak > total[2]:
+                total[2], total[3] = stats.current_streak, current_end
+            total[4] = max(total[4], best)
+        return {description: model.GoalStats(None, description, *total, today=today)
+                for description, total in goals.items()}
+
+    # yields (connection, [(schema, journal name)]) with the journals attached to a connection of their own, as many
+    # at a time as SQLite allows. Every journal is opened through the registry first, so its schema is up to date
+    def _attached(self, names: list = None):
+        names = self.names() if names is None else list(names)
+        for name in names:
+            with self.lock:
+                journal_data = self._open(name)
+            # brings the schema up to date, attached dbs aren't migrated
+            journal_data.entry_repo.conn
+        if not names:
+            return
+        connection = journal_db_connection(':memory:')
+        try:
+            if hasattr(connection, 'getlimit'):
+                group_size = connection.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+            else:
+                group_size = DEFAULT_MAX_ATTACHED
+            for start in range(0, len(names), group_size):
+                with _attach(connection, names[start:start + group_size], self.path) as schemas:
+                    yield connection, schemas
+        finally:
+            connection.close()
+
+
+# attaches the journals as j0, j1, ... for the duration of a 'with' block
+@contextmanager
+def _attach(connection: sqlite3.Connection, names: list, path_of):
+    schemas = []
+    try:
+        for index, name in enumerate(names):
+            schema = f'j{index}'
+            connection.execute('ATTACH DATABASE ? AS ' + schema, (str(path_of(name)),))
+            schemas.append((schema, name))
+        yield schemas
+    finally:
+        for schema, _ in schemas:
+            connection.execute(f'DETACH DATABASE {schema}')
@@ -1,34 +1,119 @@
 """
-TODO: Add module docs...
+Logging setup for the Journal app. configure_logger attaches a rotating log file to the journal logger. By default
+records are handed to a queue and written by a background listener thread, so callers (usually the Tk thread) never
+wait on file writes or rotation. Call shutdown_logger before the app exits to write out whatever is still queued.
 """
 
 import logging
-import pathlib
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 import config
 
 # This is the default name for the Journal logger
 JOURNAL_LOGGER_NAME = 'journal'
 
+# the listener of the queued logging mode, if it's running
+_listener = None
+
+
+class TruncatingFormatter(logging.Formatter):
+    """ Plain text formatter that cuts messages longer than max_length, entry texts can be many KB. """
+
+    def __init__(self, fmt=None, max_length=config.LOGGING_MAX_MESSAGE_LENGTH):
+        super().__init__(fmt)
+        self.max_length = max_length
+
+    def formatMessage(self, record):
+        record.message = truncate(record.message, self.max_length)
+        return super().formatMessage(record)
+
+
+class JsonFormatter(TruncatingFormatter):
+    """ Writes every record as one JSON object per line. """
+
+    def format(self, record):
+        # only imported when JSON logging is on, it isn't needed for the plain text log at startup
+        import json
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': truncate(record.getMessage(), self.max_length),
+        }
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class LazyQueueHandler(QueueHandler):
+    """ The standard QueueHandler formats the message on the caller's thread before queueing it. The queue never
+        leaves the process, so the record is queued as is and formatted by the listener thread instead. """
+
+    def prepare(self, record):
+        return record
+
+
+# returns the text cut to max_length characters, with a note of how long it was
+def truncate(text: str, max_length: int = None) -> str:
+    if max_length is None or len(text) <= max_length:
+        return text
+    return f'{text[:max_length]}...<{len(text)} chars>'
+
 
 def configure_logger(
         name = JOURNAL_LOGGER_NAME,
         log_file = config.LOGGING_FILE_NAME,
         level = config.LOGGING_LEVEL,
         size_limit = config.LOGGING_MAX_LOG_SIZE,
-        backup_count = config.LOGGING_FILE_BACKUP_COUNT):
+        backup_count = config.LOGGING_FILE_BACKUP_COUNT,
+        use_queue = config.LOGGING_QUEUE,
+        structured = config.LOGGING_JSON,
+        max_message_length = config.LOGGING_MAX_MESSAGE_LENGTH):
     """ Sets up the default Journal logger based on the values from config module. """
+    global _listener
     logger = logging.getLogger(name)
     logger.setLevel(level)
     if not logger.hasHandlers():
         # Create folder structure for log files in case it doesn't exist yet...
-        log_dir = pathlib.Path(config.LOGGING_FILE_NAME).parent
-        log_dir.mkdir(parents=True, exist_ok=True)
+        log_dir = os.path.dirname(log_file)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
         # Keep the logging configuration to a minimum
         handler = RotatingFileHandler(log_file, maxBytes=size_limit, backupCount=backup_count)
-        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        if structured:
+            handler.setFormatter(JsonFormatter(max_length=max_message_length))
+        else:
+            handler.setFormatter(TruncatingFormatter('%(asctime)s - %(levelname)s - %(message)s', max_message_length))
+
+        if use_queue:
+            log_queue = queue.SimpleQueue()
+            logger.addHandler(LazyQueueHandler(log_queue))
+            _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+            _listener.start()
+        else:
+            logger.addHandler(handler)
+
+
+def shutdown_logger(name = JOURNAL_LOGGER_NAME):
+    """
+        Stops the queued logging mode. Everything still queued is written, then the file handler is attached to the
+        logger directly, so anything logged during interpreter shutdown still reaches the file.
+    """
+    global _listener
+    if _listener is None:
+        return
+    logger = logging.getLogger(name)
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueHandler):
+            logger.removeHandler(handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.flush()
         logger.addHandler(handler)
+    _listener = None
 
 
 def journal_logger():
@@ -38,4 +123,3 @@ def journal_logger():
         function (needs to be done just once at the start of the app).
     """
     return logging.getLogger(JOURNAL_LOGGER_NAME)
-
@@ -1,32 +1,122 @@
+import time
+
+# startup phases are timed from here
+STARTED = time.perf_counter()
+
+import argparse
+import re
+import sys
 import tkinter as tk
-import sqlite3
-from contextlib import contextmanager
 
-import controller
 import logger
-from repository import GoalsRepository, EntriesRepository
-from config import WINDOW_SIZE, WINDOW_RESIZEABLE
+from config import DATABASE_NAME, JOURNAL_NAME_PATTERN, WINDOW_SIZE, WINDOW_RESIZEABLE, UI_POLL_INTERVAL_MS
+from startup import StartupProfile
 
+IMPORTED = time.perf_counter()
 
-def main():
-    """ This module starts the logger, initializes the tkinter window, initializes the controller,
-        initializes the db connection manager, then starts the tkinter mainloop """
-    logger.configure_logger()
 
+# journal names are checked before the window opens, journals.py itself is only imported after the first paint
+def journal_name(value: str) -> str:
+    if not re.fullmatch(JOURNAL_NAME_PATTERN, value):
+        raise argparse.ArgumentTypeError(f'{value!r} is not a valid journal name, use letters, digits, - and _')
+    return value
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Daily journal')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='print the time of each startup phase once the first month is shown, then exit')
+    parser.add_argument('--journal', type=journal_name,
+                        help='open this journal from the journals folder instead of the default db, created if new')
+    return parser
+
+
+def main(argv=None):
+    """ This module starts the logger, initializes the tkinter window and paints it, then imports and initializes the
+        controller and the db connection manager, then starts the tkinter mainloop. Nothing that touches the db runs
+        before the empty window is on screen. With --profile-startup the time of each phase is printed once the first
+        month is shown and the app exits, with status 1 if the first paint was over budget. --journal NAME opens that
+        journal from the journals folder, created if it's new, instead of the default db """
+    args = build_parser().parse_args(argv)
+    profile_only = args.profile_startup
+    profile = StartupProfile(STARTED)
+    profile.mark('startup imports', IMPORTED)
+
+    logger.configure_logger()
     log = logger.journal_logger()
-       
+    profile.mark('logger')
+
     root = tk.Tk()
     root.geometry(f'{WINDOW_SIZE[0]}x{WINDOW_SIZE[1]}+{WINDOW_SIZE[2]}+{WINDOW_SIZE[3]}')
     root.resizable(WINDOW_RESIZEABLE[0],WINDOW_RESIZEABLE[1])
     root.title("Daily Journal")
-    
+    profile.mark('window')
+    # draws the empty window now, rather than once mainloop starts
+    root.update()
+    profile.mark(StartupProfile.PAINT_PHASE)
+
+    # nothing on screen so far needs these, so they are imported after the first paint
+    import controller
+    from backup import BackupScheduler
+    from maintenance import RecompressJob
+    from repository import GoalsRepository, EntriesRepository, close_shared_connections
+    profile.mark('imports')
+
+    registry = None
+    if args.journal is None:
+        # both repositories share the process wide connection manager
+        database_name = DATABASE_NAME
+        journal_data = controller.JournalData(EntriesRepository(), GoalsRepository())
+    else:
+        from journals import JournalRegistry
+        registry = JournalRegistry()
+        database_name = str(registry.path(args.journal))
+        journal_data = registry.journal(args.journal, create=True)
+
+    # the first month is loaded by a worker thread
     app = controller.JournalController(
-        goals_repo=GoalsRepository(),
-        entries_repo=EntriesRepository(),
+        goals_repo=journal_data.goal_repo,
+        entries_repo=journal_data.entry_repo,
         root=root
     )
+    profile.mark('controller')
+
+    # scheduled snapshots are copied on their own thread and connection, the window never waits for them
+    backups = BackupScheduler(database_name)
+    background_jobs = []
+
+    # waits for the first month to be shown, then reports the startup and starts the background jobs
+    def first_month_shown():
+        if app.month_loading:
+            root.after(UI_POLL_INTERVAL_MS, first_month_shown)
+            return
+        profile.mark('first month')
+        if profile_only:
+            print(profile.report())
+            root.destroy()
+            return
+        log.info('Startup times\n%s', profile.report())
+        if not profile.within_budget():
+            log.warning('First paint took %.1f ms, over the %s ms budget',
+                        profile.elapsed_ms(StartupProfile.PAINT_PHASE), profile.paint_budget_ms)
+        # entries saved before the compression settings changed are converted in the background
+        background_jobs.append(RecompressJob(database_name))
+    root.after_idle(first_month_shown)
+
+    try:
+        root.mainloop()
+    finally:
+        for job in background_jobs:
+            job.stop()
+        backups.close()
+        app.close()
+        if registry is not None:
+            registry.close()
+        close_shared_connections()
+        logger.shutdown_logger()
 
-    root.mainloop()
+    if profile_only and not profile.within_budget():
+        sys.exit(1)
 
 
 if __name__ == "__main__":
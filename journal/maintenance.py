@@ -0,0 +1,39 @@
+"""
+Background maintenance of the journal db, jobs that bring existing data in line with the current settings while the
+app runs. Each job has its own connection and works in small transactions, so the app's saves never wait long on it.
+"""
+
+import threading
+
+import logger
+from config import DATABASE_NAME, ENTRY_COMPRESSION
+from repository import ConnectionManager, EntriesRepository
+
+
+class RecompressJob:
+    """ Compresses the entries that were saved before compression was turned on, or with compress=False stores them
+        all as plain text again. Runs once on a background thread, stop() ends it after the current batch. """
+
+    def __init__(self, database_name: str = DATABASE_NAME, compress: bool = ENTRY_COMPRESSION):
+        self.logger = logger.journal_logger()
+        self.database_name = database_name
+        self.compress = compress
+        self.stopped = threading.Event()
+        self.converted = None
+
+        self.thread = threading.Thread(target=self._run, name='journal-recompress', daemon=True)
+        self.thread.start()
+
+    # stops the job after the batch it is converting
+    def stop(self, timeout: float = None):
+        self.stopped.set()
+        self.thread.join(timeout)
+
+    def _run(self):
+        manager = ConnectionManager(self.database_name)
+        try:
+            self.converted = EntriesRepository(manager).recompress_entries(self.compress, stop=self.stopped.is_set)
+        except Exception as e:
+            self.logger.exception('Recompressing the entries failed: %s', e)
+        finally:
+            manager.close()
@@ -0,0 +1,283 @@
+"""
+Command line maintenance for the journal db. Run from the journal folder, for example
+    python3 manage.py rebuild-search
+"""
+
+import argparse
+import datetime
+import sys
+
+import backup
+import logger
+import transfer
+from config import BACKUP_DIR, DATABASE_NAME, JOURNALS_DIR, REVISION_COMPACT_AFTER_DAYS, TRANSFER_CHUNK_SIZE
+from controller import JournalData
+from journals import JournalError, JournalRegistry
+from repository import EntriesRepository, GoalsRepository, close_shared_connections, shared_connection_manager
+
+
+# rebuilds the full text index over the entries
+def rebuild_search(args):
+    EntriesRepository(shared_connection_manager(args.database)).rebuild_search_index()
+    print('Search index rebuilt')
+
+
+# recomputes the goal statistics from the goal states
+def rebuild_goal_stats(args):
+    GoalsRepository(shared_connection_manager(args.database)).rebuild_goal_stats()
+    print('Goal statistics rebuilt')
+
+
+# takes a snapshot of the db now
+def backup_now(args):
+    try:
+        path = backup.create_backup(args.database, args.backup_dir, progress=_print_fraction)
+    except backup.BackupError as e:
+        sys.exit(f'\nBackup failed: {e}')
+    print(f'\nBacked up to {path}')
+
+
+# lists the snapshots, newest first, optionally checking each one
+def list_backups(args):
+    for path in backup.list_backups(args.database, args.backup_dir):
+        status = ''
+        if args.verify:
+            problems = backup.verify_backup(path)
+            status = '  ok' if not problems else '  FAILED: ' + '; '.join(problems)
+        print(f'{path}  {path.stat().st_size // 1024} KB{status}')
+
+
+# replaces the db with a snapshot, the app must be closed
+def restore(args):
+    try:
+        previous = backup.restore_backup(args.path, args.database, args.backup_dir)
+    except backup.BackupError as e:
+        sys.exit(f'Restore failed: {e}')
+    print(f'Restored {args.database} from {args.path}')
+    if previous is not None:
+        print(f'The db as it was before is in {previous}')
+
+
+# lists the revisions of a date's entry, or shows the changes between two of them
+def revisions(args):
+    repo = EntriesRepository(shared_connection_manager(args.database))
+    date = datetime.date.fromisoformat(args.date)
+    if args.diff:
+        for line in repo.diff_revisions(date, *args.diff):
+            print(line)
+        return
+    for revision, created, char_count in repo.get_revisions(date):
+        print(f'{revision:>4}  {created}  {char_count} chars')
+
+
+# makes an earlier revision a date's entry again, the app should be closed
+def restore_revision(args):
+    repo = EntriesRepository(shared_connection_manager(args.database))
+    try:
+        repo.restore_revision(datetime.date.fromisoformat(args.date), args.revision)
+    except ValueError as e:
+        sys.exit(str(e))
+    print(f'Restored revision {args.revision} of {args.date}')
+
+
+# thins out old revisions and reports how much space the history takes
+def compact_revisions(args):
+    repo = EntriesRepository(shared_connection_manager(args.database))
+    removed = repo.compact_revisions(args.older_than)
+    count, stored, full = repo.revision_storage()
+    print(f'Removed {removed} revisions, {count} left in {stored // 1024} KB '
+          f'({stored / full if full else 0:.1%} of full copies)')
+
+
+# compresses the long entries saved as plain text, or with --decompress stores every entry as plain text, then reports
+# how much the compression saves
+def compress_entries(args):
+    repo = EntriesRepository(shared_connection_manager(args.database))
+    converted = repo.recompress_entries(not args.decompress, pause=0)
+    count, compressed, text_bytes, stored_bytes = repo.compression_stats()
+    print(f'Converted {converted} entries. {compressed} of {count} entries are compressed, '
+          f'{text_bytes // 1024} KB of text stored in {stored_bytes // 1024} KB '
+          f'(ratio {text_bytes / stored_bytes if stored_bytes else 1:.2f})')
+
+
+# prints the best matching entries for the given keywords, in one journal or with --all-journals in every journal
+def search(args):
+    first_day = datetime.date.fromisoformat(args.first_day) if args.first_day else None
+    last_day = datetime.date.fromisoformat(args.last_day) if args.last_day else None
+    if args.all_journals:
+        registry = JournalRegistry(args.journals_dir)
+        try:
+            results = registry.search(args.keywords, None, first_day, last_day, args.limit, args.offset, args.raw)
+        finally:
+            registry.close()
+        for journal, date, snippet, rank in results:
+            print(f'{journal}  {date}  {snippet}')
+        return
+    repo = EntriesRepository(shared_connection_manager(args.database))
+    results = repo.search_entries(args.keywords, first_day, last_day, args.limit, args.offset, raw=args.raw)
+    for date, snippet, rank in results:
+        print(f'{date}  {snippet}')
+
+
+# prints what was written on a date, today by default, in earlier years
+def on_this_day(args):
+    repo = EntriesRepository(shared_connection_manager(args.database))
+    date = datetime.date.fromisoformat(args.date) if args.date else datetime.date.today()
+    for entry_date, text in repo.get_on_this_day(date, args.years):
+        print(f'{entry_date}\n{text}\n')
+
+
+# prints the totals and streaks of every goal, of one journal or with --all-journals added up over every journal
+def goal_stats(args):
+    if args.all_journals:
+        registry = JournalRegistry(args.journals_dir)
+        try:
+            stats = registry.goal_stats()
+        finally:
+            registry.close()
+    else:
+        stats = {goal.description: goal for goal in _journal_data(args).goal_stats().values()}
+    for description, goal in stats.items():
+        print(f'{description}: {goal.completed_days} of {goal.tracked_days} days ({goal.completion_ratio:.0%}), '
+              f'current streak {goal.current_streak}, best streak {goal.best_streak}')
+
+
+# lists the journals in the journals folder with the size of their db files
+def list_journals(args):
+    registry = JournalRegistry(args.journals_dir)
+    for name in registry.names():
+        print(f'{name}  {registry.path(name).stat().st_size // 1024} KB')
+
+
+# writes the whole journal to a JSON lines or CSV file
+def export_journal(args):
+    count = transfer.export_journal(_journal_data(args), args.path, args.format, progress=_print_progress('days'))
+    print(f'\nExported {count} days to {args.path}')
+
+
+# reads a JSON lines or CSV file into the journal
+def import_journal(args):
+    try:
+        count = transfer.import_journal(_journal_data(args), args.path, args.format, args.chunk_size, args.resume,
+                                        progress=_print_progress('records'))
+    except transfer.TransferError as e:
+        sys.exit(f'\nImport failed: {e}')
+    print(f'\nImported {count} records from {args.path}')
+
+
+def _journal_data(args) -> JournalData:
+    manager = shared_connection_manager(args.database)
+    return JournalData(EntriesRepository(manager), GoalsRepository(manager))
+
+
+def _print_fraction(done, total):
+    print(f'\r{done}/{total} pages', end='', file=sys.stderr, flush=True)
+
+
+# progress callback that keeps rewriting one line on stderr
+def _print_progress(unit: str):
+    def progress(count):
+        print(f'\r{count} {unit}', end='', file=sys.stderr, flush=True)
+    return progress
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Journal db maintenance commands')
+    parser.add_argument('--database', default=DATABASE_NAME, help='journal db file')
+    parser.add_argument('--backup-dir', default=BACKUP_DIR, help='folder the snapshots are kept in')
+    parser.add_argument('--journal', help='use this journal from the journals folder instead of --database')
+    parser.add_argument('--journals-dir', default=JOURNALS_DIR, help='folder the journals are kept in')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    rebuild_parser = subparsers.add_parser('rebuild-search', help='rebuild the full text search index')
+    rebuild_parser.set_defaults(func=rebuild_search)
+
+    journals_parser = subparsers.add_parser('journals', help='list the journals')
+    journals_parser.set_defaults(func=list_journals)
+
+    goal_stats_parser = subparsers.add_parser('goal-stats', help='show the totals and streaks of every goal')
+    goal_stats_parser.add_argument('--all-journals', action='store_true', help='add them up over every journal')
+    goal_stats_parser.set_defaults(func=goal_stats)
+
+    stats_parser = subparsers.add_parser('rebuild-goal-stats', help='recompute the goal statistics')
+    stats_parser.set_defaults(func=rebuild_goal_stats)
+
+    export_parser = subparsers.add_parser('export', help='export the journal to a JSON lines or CSV file')
+    export_parser.add_argument('path')
+    export_parser.add_argument('--format', choices=transfer.FORMATS, help='defaults to csv for .csv files, else jsonl')
+    export_parser.set_defaults(func=export_journal)
+
+    import_parser = subparsers.add_parser('import', help='import a JSON lines or CSV file into the journal')
+    import_parser.add_argument('path')
+    import_parser.add_argument('--format', choices=transfer.FORMATS, help='defaults to csv for .csv files, else jsonl')
+    import_parser.add_argument('--chunk-size', type=int, default=TRANSFER_CHUNK_SIZE, help='days per transaction')
+    import_parser.add_argument('--resume', action='store_true', help='continue an interrupted import of the same file')
+    import_parser.set_defaults(func=import_journal)
+
+    backup_parser = subparsers.add_parser('backup', help='take a snapshot of the db, safe while the app is running')
+    backup_parser.set_defaults(func=backup_now)
+
+    backups_parser = subparsers.add_parser('backups', help='list the snapshots, newest first')
+    backups_parser.add_argument('--verify', action='store_true', help='run an integrity check on each snapshot')
+    backups_parser.set_defaults(func=list_backups)
+
+    restore_parser = subparsers.add_parser('restore', help='replace the db with a snapshot, close the app first')
+    restore_parser.add_argument('path')
+    restore_parser.set_defaults(func=restore)
+
+    revisions_parser = subparsers.add_parser('revisions', help='list the revisions of an entry')
+    revisions_parser.add_argument('date', help='YYYY-MM-DD')
+    revisions_parser.add_argument('--diff', nargs=2, type=int, metavar=('OLD', 'NEW'), help='show the changes instead')
+    revisions_parser.set_defaults(func=revisions)
+
+    restore_revision_parser = subparsers.add_parser('restore-revision', help='make an earlier revision the entry again')
+    restore_revision_parser.add_argument('date', help='YYYY-MM-DD')
+    restore_revision_parser.add_argument('revision', type=int)
+    restore_revision_parser.set_defaults(func=restore_revision)
+
+    compact_parser = subparsers.add_parser('compact-revisions', help='thin out old revisions')
+    compact_parser.add_argument('--older-than', type=int, default=REVISION_COMPACT_AFTER_DAYS, metavar='DAYS',
+                                help='revisions older than this keep only the last of each day')
+    compact_parser.set_defaults(func=compact_revisions)
+
+    compress_parser = subparsers.add_parser('compress-entries', help='compress the existing long entries')
+    compress_parser.add_argument('--decompress', action='store_true', help='store every entry as plain text instead')
+    compress_parser.set_defaults(func=compress_entries)
+
+    on_this_day_parser = subparsers.add_parser('on-this-day', help='show the entries from this day in earlier years')
+    on_this_day_parser.add_argument('date', nargs='?', help='YYYY-MM-DD, defaults to today')
+    on_this_day_parser.add_argument('--years', type=int, help='how many years back to look')
+    on_this_day_parser.set_defaults(func=on_this_day)
+
+    search_parser = subparsers.add_parser('search', help='search the journal entries')
+    search_parser.add_argument('keywords')
+    search_parser.add_argument('--from', dest='first_day', help='first date to search, YYYY-MM-DD')
+    search_parser.add_argument('--to', dest='last_day', help='last date to search, YYYY-MM-DD')
+    search_parser.add_argument('--limit', type=int, default=20)
+    search_parser.add_argument('--offset', type=int, default=0)
+    search_parser.add_argument('--raw', action='store_true', help='use FTS5 query syntax')
+    search_parser.add_argument('--all-journals', action='store_true', help='search every journal')
+    search_parser.set_defaults(func=search)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.journal is not None:
+        try:
+            path = JournalRegistry(args.journals_dir).path(args.journal)
+        except JournalError as e:
+            sys.exit(str(e))
+        # naming a journal that doesn't exist yet creates it, for example by importing into it
+        path.parent.mkdir(parents=True, exist_ok=True)
+        args.database = str(path)
+    logger.configure_logger()
+    try:
+        args.func(args)
+    finally:
+        close_shared_connections()
+        logger.shutdown_logger()
+
+
+if __name__ == "__main__":
+    main()
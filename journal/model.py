@@ -2,98 +2,257 @@
 
 import calendar as cal
 import datetime
+from collections import namedtuple
+from functools import lru_cache
+
+
+# marks a day whose entry is in the db but whose text hasn't been fetched yet
+NOT_LOADED = object()
+
+
+# calendar layout of a month. weeks is always 6 'weeks' of 7 day numbers, 0 where the day belongs to another month.
+# first_weekday is the weekday of the 1st, Monday = 0
+MonthTemplate = namedtuple('MonthTemplate', ['weeks', 'first_weekday', 'days_in_month'])
+
+
+# every Month of the same year and month has the same layout, so it is only built once
+@lru_cache(maxsize=256)
+def month_template(year: int, month_num: int) -> MonthTemplate:
+    weeks = [tuple(week) for week in cal.monthcalendar(year, month_num)]
+    # ensures the reference calendar matrix is 6 'weeks' long
+    while len(weeks) < 6:
+        weeks.append((0, 0, 0, 0, 0, 0, 0))
+    first_weekday, days_in_month = cal.monthrange(year, month_num)
+    return MonthTemplate(tuple(weeks), first_weekday, days_in_month)
 
 
 class Day():
-    def __init__(self, date, entry = None, goals = None, entry_id = None):
+    # slots keep the per day footprint small, months are kept resident by the cache
+    __slots__ = ('date', '_entry', 'char_count', 'word_count', 'day_num', 'entry_id', 'month', '_goals')
+
+    def __init__(self, date, entry = None, goals = None, entry_id = None, month = None):
         self.date = date
-        self.entry = entry
-        self.goals = goals if goals is not None else {}
+        self.set_entry(entry)
         self.day_num = self.get_day_num()
         self.entry_id = entry_id
+        # days that belong to a Month keep their goal states in the month's bitmasks, a standalone day uses a dict
+        self.month = month
+        self._goals = None if month is not None else {}
+        if goals:
+            self.add_goals(goals)
+
+    # the entry text for the day. Days loaded as part of a month only know the entry's counts, the text is fetched
+    # through the month when it's first asked for
+    @property
+    def entry(self):
+        if self._entry is NOT_LOADED:
+            return self.month.load_entry(self.date)
+        return self._entry
 
     # sets the entry text for the day
     def set_entry(self, entry):
-        self.entry = entry
+        self._entry = entry
+        if entry is None:
+            self.char_count = self.word_count = None
+        else:
+            self.char_count, self.word_count = len(entry), len(entry.split())
+
+    # records that the day has an entry in the db without loading its text
+    def set_entry_info(self, char_count, word_count):
+        self._entry = NOT_LOADED
+        self.char_count = char_count
+        self.word_count = word_count
+
+    # True if the day has an entry, without loading it
+    @property
+    def has_entry(self) -> bool:
+        return self._entry is not None
 
     #returns the number of the day
     def get_day_num(self):
         day_num = self.date.day
         return day_num
-    
-    # adds the parts of the goals list to the goals dictionary, key = goal id, values = [goal description, state]
-    def add_goals(self, goals_list):
-        for goal in goals_list:
-            id, description, state = goal
 
+    # the goals for the day, key = goal id, values = (goal description, state)
+    @property
+    def goals(self) -> dict:
+        if self.month is None:
+            return self._goals
+        return self.month.get_day_goals(self.day_num)
+
+    # adds goals to the goals dictionary, takes a dictionary of key = goal id, values = (goal description, state)
+    def add_goals(self, goals):
+        if self.month is None:
+            self._goals.update(goals)
+        else:
+            self.month.set_day_goals(self.day_num, goals)
 
-#basic month class, builds and holds the day classes in a matrix
+
+#basic month class, builds and holds the day classes
 class Month():
-    def __init__(self, date):
+    __slots__ = ('month_num', 'year', 'month_name', 'template', 'days', 'goal_descriptions', 'goal_tracked', 'goal_states',
+                 'entry_loader')
+
+    # entry_loader is called with a date to fetch the text of an entry that wasn't loaded with the month
+    def __init__(self, date, entry_loader = None):
         self.month_num = date.month
         self.year = date.year
-        
+
         self.month_name = self.set_month_name()
-        self.calendar_matrix = self.initialize_calendar_matrix()
+        self.template = month_template(self.year, self.month_num)
+        # days[day_num - 1] is the Day for day_num
+        self.days = [Day(datetime.date(self.year, self.month_num, day_num), month=self)
+                     for day_num in range(1, self.template.days_in_month + 1)]
+
+        # goal states for the whole month, one bit per day (bit 0 is the 1st). goal_tracked marks the days that have a
+        # state for the goal at all, goal_states the days it was completed
+        self.goal_descriptions = {}
+        self.goal_tracked = {}
+        self.goal_states = {}
+        self.entry_loader = entry_loader
 
     # returns the string of the month name
     def set_month_name(self):
         return cal.month_name[self.month_num]
-    
-    # builds each day and then adds it to a month matrix, [month[week[day]]]
-    def initialize_calendar_matrix(self):
-        #blank calendar matrix
-        calendar_matrix = []
-
-        # builds the base reference calendar, also where the day objects get their date
-        cal_matrix = cal.monthcalendar(self.year, self.month_num)
-        
-        # ensures the reference calendar matrix is 6 'weeks' long
-        while len(cal_matrix) < 6:
-            cal_matrix.append([0,0,0,0,0,0,0])
-        
-        index_dict = {}
-
-        # iterrates over the reference matrix and adds days where appropriate
-        for w,week in enumerate(cal_matrix):
-            week_list = []
-
-            for i, week_day in enumerate(week):
-                if week_day == 0:
-                    week_list.append(None)
-                else:
-                    date = datetime.date(self.year, self.month_num, week_day)
-                    day = Day(date)
-
-                    index_dict[week_day] = (w+1,i)
-
-                    week_list.append(day)
-            calendar_matrix.append(week_list)
-
-        # insert the index dict at the beginning of the calendar_matrix to easily find the correct
-
-        calendar_matrix.insert(0, index_dict)
-
-        return calendar_matrix
-    
+
+    # the days laid out as [month[week[day]]], 6 weeks of 7 with None for days outside the month. Built from the cached
+    # template on request, it isn't stored on the month
+    @property
+    def calendar_matrix(self) -> list[list]:
+        days = self.days
+        return [[days[day_num - 1] if day_num else None for day_num in week] for week in self.template.weeks]
+
+    # returns the (week, weekday) position of a day in calendar_matrix
+    def get_day_position(self, day_num) -> tuple:
+        return divmod(self.template.first_weekday + day_num - 1, 7)
+
     # returns a specific day
     def get_day(self, day_num):
-        
-        index = self.calendar_matrix[0]
-        w,i = index[day_num]
-        return self.calendar_matrix[w][i]
-    
-    #adds all data to days of month. Entries tuples will be (date, entry). goals tuple will be (goal id, state)
-    def data_to_days(self,entries: list[tuple],goals: list[tuple]):
-        for entry in entries:
-            day_num = datetime.datetime.strptime(entry[0], '%Y-%m-%d').date().day
-            day = self.get_day(day_num)
-            day.set_entry(entry[1])
-
-        for goal in goals:
-            day_num = datetime.datetime.strptime(entry[0], '%Y-%m-%d').date().day
-            day = self.get_day(day_num)
-            goal = [goal]
-            day.add_goals(goal)
+        return self.days[day_num - 1]
+
+    # fetches the text of a day's entry, the month doesn't keep it
+    def load_entry(self, date):
+        if self.entry_loader is None:
+            return None
+        return self.entry_loader(date)
+
+    # returns the goals of a day, {goal_id: (description, state)}
+    def get_day_goals(self, day_num) -> dict:
+        bit = 1 << (day_num - 1)
+        return {goal_id: (self.goal_descriptions[goal_id], 1 if self.goal_states[goal_id] & bit else 0)
+                for goal_id, tracked in self.goal_tracked.items() if tracked & bit}
+
+    # sets goal states for a day, takes {goal_id: (description, state)}
+    def set_day_goals(self, day_num, goals: dict):
+        bit = 1 << (day_num - 1)
+        for goal_id, (description, state) in goals.items():
+            self.goal_descriptions[goal_id] = description
+            self.goal_tracked[goal_id] = self.goal_tracked.get(goal_id, 0) | bit
+            if state:
+                self.goal_states[goal_id] = self.goal_states.get(goal_id, 0) | bit
+            else:
+                self.goal_states[goal_id] = self.goal_states.get(goal_id, 0) & ~bit
+
+    # adds all data to days of month. Takes the month snapshot from the repository,
+    # {day_num: [(char_count, word_count), {goal_id: (description, state)}]}
+    def data_to_days(self, days: dict[int, list]):
+        for day_num, (entry_info, goals) in days.items():
+            if entry_info is not None:
+                self.days[day_num - 1].set_entry_info(*entry_info)
+            if goals:
+                self.set_day_goals(day_num, goals)
+
+
+# goal completion over a date range, packed as bitsets with one bit per day (bit 0 is first_day)
+class GoalProgress():
+    __slots__ = ('goal_id', 'description', 'first_day', 'day_count', 'tracked', 'completed', 'tracked_days',
+                 'completed_days', 'completion_ratio', 'current_streak', 'best_streak')
+
+    # the current streak is counted back from today when the range reaches past it
+    def __init__(self, goal_id, description, first_day: datetime.date, last_day: datetime.date, tracked = 0, completed = 0,
+                 today: datetime.date = None):
+        self.goal_id = goal_id
+        self.description = description
+        self.first_day = first_day
+        self.day_count = (last_day - first_day).days + 1
+        # tracked marks the days that have a state for the goal, completed the days it was completed
+        self.tracked = tracked
+        self.completed = completed
+
+        # everything below is worked out once, so views can read it without walking the days
+        self.tracked_days = tracked.bit_count()
+        self.completed_days = completed.bit_count()
+        self.completion_ratio = self.completed_days / self.tracked_days if self.tracked_days else 0.0
+        today = today if today is not None else datetime.date.today()
+        self.best_streak = self.get_best_streak()
+        self.current_streak = self.get_current_streak(min((today - first_day).days, self.day_count - 1))
+
+    # builds the progress for a goal from (entry_date, state) pairs, dates in .isoformat()
+    @classmethod
+    def from_states(cls, goal_id, description, first_day: datetime.date, last_day: datetime.date, states,
+                    today: datetime.date = None):
+        first_ordinal = first_day.toordinal()
+        tracked = completed = 0
+        for entry_date, state in states:
+            bit = 1 << (datetime.date.fromisoformat(entry_date).toordinal() - first_ordinal)
+            tracked |= bit
+            if state:
+                completed |= bit
+        return cls(goal_id, description, first_day, last_day, tracked, completed, today)
+
+    # True if the goal was completed on the date
+    def is_completed(self, date: datetime.date) -> bool:
+        offset = (date - self.first_day).days
+        return 0 <= offset < self.day_count and bool(self.completed >> offset & 1)
+
+    # the states for every day of the range, 1 completed, 0 not completed, None no state
+    def day_states(self) -> list:
+        return [(self.completed >> offset & 1) if self.tracked >> offset & 1 else None for offset in range(self.day_count)]
+
+    # the longest run of completed days. Each pass shortens every run of set bits by one
+    def get_best_streak(self) -> int:
+        runs = self.completed
+        streak = 0
+        while runs:
+            runs &= runs >> 1
+            streak += 1
+        return streak
+
+    # the run of completed days up to the day at offset last. If that day isn't completed (yet) the run ending the day
+    # before counts, so today's unticked goal doesn't reset the streak
+    def get_current_streak(self, last: int) -> int:
+        if last < 0:
+            return 0
+        if not self.completed >> last & 1:
+            last -= 1
+        if last < 0:
+            return 0
+        window = (1 << (last + 1)) - 1
+        gaps = ~self.completed & window
+        return last + 1 - gaps.bit_length() if gaps else last + 1
+
+
+# a goal's totals and streaks over its whole history, read from the precomputed goal statistics
+class GoalStats():
+    __slots__ = ('goal_id', 'description', 'tracked_days', 'completed_days', 'completion_ratio', 'current_streak',
+                 'best_streak')
 
+    # the stored current streak ends on the latest completed day. It only still counts if that day is today or yesterday,
+    # so today's unticked goal doesn't reset it
+    def __init__(self, goal_id, description, tracked_days, completed_days, current_streak, current_streak_end,
+                 best_streak, today: datetime.date = None):
+        self.goal_id = goal_id
+        self.description = description
+        self.tracked_days = tracked_days
+        self.completed_days = completed_days
+        self.completion_ratio = completed_days / tracked_days if tracked_days else 0.0
+        self.best_streak = best_streak
+        today = today if today is not None else datetime.date.today()
+        if current_streak_end is None or (today - datetime.date.fromisoformat(current_streak_end)).days > 1:
+            current_streak = 0
+        self.current_streak = current_streak
 
+    # completion of a goal per month, [(month 'YYYY-MM', tracked_days, completed_days)] to {month: ratio}
+    @staticmethod
+    def monthly_ratios(months: list[tuple]) -> dict:
+        return {month: completed / tracked if tracked else 0.0 for month, tracked, completed in months}
@@ -1,26 +1,45 @@
 """
 This is the main data access module. It contains the BaseRepository parent class, which both the EntriesRepository and GoalsRepository classes use.
-The db connection and initialization have been separated from the repository classes.
+The db connection and initialization have been separated from the repository classes, connections are owned by a
+ConnectionManager that every repository for the same db shares.
 """
 
+import atexit
+import calendar
 import datetime
+import json
+import pathlib
+import queue
+import re
 import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
 from contextlib import contextmanager
 
 import logger
-from config import DATABASE_NAME, GOALS_STATE_TABLE, GOALS_TABLE, ENTRIES_TABLE
+from config import (DATABASE_NAME, GOALS_STATE_TABLE, GOALS_TABLE, ENTRIES_TABLE, ENTRIES_FTS_TABLE, GOAL_STATS_TABLE,
+                    GOAL_STATS_MONTHLY_TABLE, DB_JOURNAL_MODE,
+                    DB_SYNCHRONOUS, DB_CACHE_SIZE, DB_MMAP_SIZE, DB_TEMP_STORE, DB_STATEMENT_CACHE_SIZE,
+                    SEARCH_HIGHLIGHT, SEARCH_SNIPPET_TOKENS, SEARCH_PAGE_SIZE, QUERY_STATS_ENABLED, QUERY_SLOW_MS,
+                    QUERY_STATS_SAMPLES, QUERY_STATS_FILE, LOG_VALUE_MAX_LENGTH, TRANSFER_PAGE_SIZE,
+                    ENTRY_REVISIONS_TABLE, REVISIONS_ENABLED, REVISION_SNAPSHOT_INTERVAL, REVISION_MERGE_SECONDS,
+                    REVISION_COMPACT_AFTER_DAYS, ENTRIES_TEXT_VIEW, ENTRY_COMPRESSION, ENTRY_COMPRESS_MIN_CHARS,
+                    ENTRY_COMPRESS_LEVEL, ENTRY_RECOMPRESS_BATCH, ENTRY_RECOMPRESS_PAUSE)
 
 
-# initialize the db and tables if needed
-def initialize_journal_db(connection: sqlite3.Connection, logger: logger) -> None:
-    """ Function responsible for initializing Journal DB. """
-    # Querys to create the appropriate tables
-    goals_table_query = f'''
+# Schema migrations. Each function upgrades the schema by exactly one version, the version it produces is its
+# position in MIGRATIONS + 1 and is recorded with PRAGMA user_version. Migrations are only ever appended, never edited,
+# so every existing journal_data.db can be walked forward in place.
+def _create_base_tables(cursor: sqlite3.Cursor) -> None:
+    """ Version 1, the original tables. IF NOT EXISTS keeps this safe for dbs created before versioning. """
+    cursor.execute(f'''
     CREATE TABLE IF NOT EXISTS {GOALS_TABLE} (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     goal_description TEXT UNIQUE
-    )'''
-    goals_state_table_query = f'''
+    )''')
+    cursor.execute(f'''
     CREATE TABLE IF NOT EXISTS {GOALS_STATE_TABLE} (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     entry_date DATE NOT NULL,
@@ -28,57 +47,642 @@ def initialize_journal_db(connection: sqlite3.Connection, logger: logger) -> Non
     state BOOLEAN DEFAULT 0,
     FOREIGN KEY (entry_date) REFERENCES entries(date) ON DELETE CASCADE,
     FOREIGN KEY (goal_id) REFERENCES goals(id) ON DELETE CASCADE
-    )'''
-    entry_table_query = '''
-        CREATE TABLE IF NOT EXISTS entries (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        date DATE UNIQUE,
-        entry TEXT
-        )'''
-    try:
-        cursor = connection.cursor()
-        cursor.execute(goals_table_query)
-        cursor.execute(goals_state_table_query)
-        cursor.execute(entry_table_query)
-        connection.commit()
-    except sqlite3.IntegrityError as e:
-        connection.rollback()
-        logger.exception('SQLite error: %s', e)
-    except Exception as e:
-        connection.rollback()
-        logger.exception('Error at: %s', e)
-        raise
+    )''')
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {ENTRIES_TABLE} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    date DATE UNIQUE,
+    entry TEXT
+    )''')
+
+
+def _index_goals_state(cursor: sqlite3.Cursor) -> None:
+    """ Version 2, one goal state per (entry_date, goal_id) and an index for per goal lookups. """
+    # keep the most recently written row of any duplicates, that is the state the user saw last
+    cursor.execute(f'''
+    DELETE FROM {GOALS_STATE_TABLE} WHERE id NOT IN (
+    SELECT MAX(id) FROM {GOALS_STATE_TABLE} GROUP BY entry_date, goal_id
+    )''')
+    # sqlite can't add a constraint to an existing table, a unique index enforces the same thing
+    cursor.execute(f'''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_{GOALS_STATE_TABLE}_date_goal
+    ON {GOALS_STATE_TABLE} (entry_date, goal_id)''')
+    cursor.execute(f'''
+    CREATE INDEX IF NOT EXISTS idx_{GOALS_STATE_TABLE}_goal_date
+    ON {GOALS_STATE_TABLE} (goal_id, entry_date)''')
+
+
+def _create_entries_search(cursor: sqlite3.Cursor) -> None:
+    """ Version 3, an FTS5 index over the entry text, kept in sync with the entries table by triggers. """
+    # external content table, the text itself is only stored once in entries
+    cursor.execute(f'''
+    CREATE VIRTUAL TABLE IF NOT EXISTS {ENTRIES_FTS_TABLE} USING fts5(
+    entry, content='{ENTRIES_TABLE}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {ENTRIES_TABLE}_fts_insert AFTER INSERT ON {ENTRIES_TABLE} BEGIN
+    INSERT INTO {ENTRIES_FTS_TABLE} (rowid, entry) VALUES (new.id, new.entry);
+    END''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {ENTRIES_TABLE}_fts_delete AFTER DELETE ON {ENTRIES_TABLE} BEGIN
+    INSERT INTO {ENTRIES_FTS_TABLE} ({ENTRIES_FTS_TABLE}, rowid, entry) VALUES ('delete', old.id, old.entry);
+    END''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {ENTRIES_TABLE}_fts_update AFTER UPDATE OF entry ON {ENTRIES_TABLE} BEGIN
+    INSERT INTO {ENTRIES_FTS_TABLE} ({ENTRIES_FTS_TABLE}, rowid, entry) VALUES ('delete', old.id, old.entry);
+    INSERT INTO {ENTRIES_FTS_TABLE} (rowid, entry) VALUES (new.id, new.entry);
+    END''')
+    # index the entries written before this version
+    cursor.execute(f"INSERT INTO {ENTRIES_FTS_TABLE} ({ENTRIES_FTS_TABLE}) VALUES ('rebuild')")
+
+
+def _add_entry_counts(cursor: sqlite3.Cursor) -> None:
+    """ Version 4, character and word counts stored next to the entry, so month views don't need the text. """
+    cursor.execute(f'ALTER TABLE {ENTRIES_TABLE} ADD COLUMN char_count INTEGER')
+    cursor.execute(f'ALTER TABLE {ENTRIES_TABLE} ADD COLUMN word_count INTEGER')
+    # word counts use Python's split, so they are filled in here rather than with an UPDATE expression
+    rows = cursor.execute(f'SELECT id, entry FROM {ENTRIES_TABLE}').fetchall()
+    cursor.executemany(f'UPDATE {ENTRIES_TABLE} SET char_count = ?, word_count = ? WHERE id = ?',
+                       [(*entry_counts(entry), entry_id) for entry_id, entry in rows])
+
+
+def _create_goal_stats(cursor: sqlite3.Cursor) -> None:
+    """ Version 5, goal statistics rollups. Day counts are kept by triggers, streaks by GoalsRepository. """
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {GOAL_STATS_MONTHLY_TABLE} (
+    goal_id INTEGER NOT NULL,
+    month TEXT NOT NULL,
+    tracked_days INTEGER NOT NULL DEFAULT 0,
+    completed_days INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (goal_id, month)
+    ) WITHOUT ROWID''')
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {GOAL_STATS_TABLE} (
+    goal_id INTEGER PRIMARY KEY,
+    tracked_days INTEGER NOT NULL DEFAULT 0,
+    completed_days INTEGER NOT NULL DEFAULT 0,
+    current_streak INTEGER NOT NULL DEFAULT 0,
+    current_streak_end DATE,
+    best_streak INTEGER NOT NULL DEFAULT 0,
+    best_streak_end DATE
+    )''')
+
+    # adding and removing a goal state's day from both rollups, shared by the three triggers below
+    add_state = f'''
+    INSERT INTO {GOAL_STATS_MONTHLY_TABLE} (goal_id, month, tracked_days, completed_days)
+    VALUES (new.goal_id, substr(new.entry_date, 1, 7), 1, coalesce(new.state, 0) != 0)
+    ON CONFLICT (goal_id, month) DO UPDATE SET
+    tracked_days = tracked_days + 1, completed_days = completed_days + excluded.completed_days;
+    INSERT INTO {GOAL_STATS_TABLE} (goal_id, tracked_days, completed_days)
+    VALUES (new.goal_id, 1, coalesce(new.state, 0) != 0)
+    ON CONFLICT (goal_id) DO UPDATE SET
+    tracked_days = tracked_days + 1, completed_days = completed_days + excluded.completed_days;'''
+    remove_state = f'''
+    UPDATE {GOAL_STATS_MONTHLY_TABLE} SET
+    tracked_days = tracked_days - 1, completed_days = completed_days - (coalesce(old.state, 0) != 0)
+    WHERE goal_id = old.goal_id AND month = substr(old.entry_date, 1, 7);
+    DELETE FROM {GOAL_STATS_MONTHLY_TABLE}
+    WHERE goal_id = old.goal_id AND month = substr(old.entry_date, 1, 7) AND tracked_days = 0;
+    UPDATE {GOAL_STATS_TABLE} SET
+    tracked_days = tracked_days - 1, completed_days = completed_days - (coalesce(old.state, 0) != 0)
+    WHERE goal_id = old.goal_id;'''
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {GOALS_STATE_TABLE}_stats_insert AFTER INSERT ON {GOALS_STATE_TABLE} BEGIN
+    {add_state}
+    END''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {GOALS_STATE_TABLE}_stats_delete AFTER DELETE ON {GOALS_STATE_TABLE} BEGIN
+    {remove_state}
+    END''')
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS {GOALS_STATE_TABLE}_stats_update
+    AFTER UPDATE OF entry_date, goal_id, state ON {GOALS_STATE_TABLE} BEGIN
+    {remove_state}
+    {add_state}
+    END''')
+    rebuild_goal_stats(cursor)
+
+
+def _create_entry_revisions(cursor: sqlite3.Cursor) -> None:
+    """ Version 6, revision history of the entries, compressed full copies and deltas. """
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS {ENTRY_REVISIONS_TABLE} (
+    entry_date DATE NOT NULL,
+    revision INTEGER NOT NULL,
+    created TEXT NOT NULL,
+    snapshot BOOLEAN NOT NULL,
+    data BLOB NOT NULL,
+    char_count INTEGER NOT NULL,
+    PRIMARY KEY (entry_date, revision)
+    )''')
+
+
+def _add_entry_compression(cursor: sqlite3.Cursor) -> None:
+    """ Version 7, entries may be stored compressed. The search index reads the plain text through a view. """
+    # 0 plain text, 1 zlib compressed utf-8
+    cursor.execute(f'ALTER TABLE {ENTRIES_TABLE} ADD COLUMN compressed INTEGER NOT NULL DEFAULT 0')
+    # finds the entries the recompression job still has to convert without reading the texts
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_entries_compressed ON {ENTRIES_TABLE} (compressed, char_count)')
+    cursor.execute(f'''
+    CREATE VIEW IF NOT EXISTS {ENTRIES_TEXT_VIEW} AS
+    SELECT id, date, entry_plain(entry, compressed) AS entry FROM {ENTRIES_TABLE}''')
+
+    # the external content index is recreated over the view, so snippets and rebuilds never see compressed bytes
+    for trigger in ('insert', 'delete', 'update'):
+        cursor.execute(f'DROP TRIGGER IF EXISTS {ENTRIES_TABLE}_fts_{trigger}')
+    cursor.execute(f'DROP TABLE IF EXISTS {ENTRIES_FTS_TABLE}')
+    cursor.execute(f'''
+    CREATE VIRTUAL TABLE {ENTRIES_FTS_TABLE} USING fts5(
+    entry, content='{ENTRIES_TEXT_VIEW}', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+    )''')
+    cursor.execute(f'''
+    CREATE TRIGGER {ENTRIES_TABLE}_fts_insert AFTER INSERT ON {ENTRIES_TABLE} BEGIN
+    INSERT INTO {ENTRIES_FTS_TABLE} (rowid, entry) VALUES (new.id, entry_plain(new.entry, new.compressed));
+    END''')
+    cursor.execute(f'''
+    CREATE TRIGGER {ENTRIES_TABLE}_fts_delete AFTER DELETE ON {ENTRIES_TABLE} BEGIN
+    INSERT INTO {ENTRIES_FTS_TABLE} ({ENTRIES_FTS_TABLE}, rowid, entry)
+    VALUES ('delete', old.id, entry_plain(old.entry, old.compressed));
+    END''')
+    # recompressing an entry changes how it's stored but not its text, the index is only touched when the text changes
+    cursor.execute(f'''
+    CREATE TRIGGER {ENTRIES_TABLE}_fts_update AFTER UPDATE OF entry ON {ENTRIES_TABLE}
+    WHEN entry_plain(old.entry, old.compressed) IS NOT entry_plain(new.entry, new.compressed) BEGIN
+    INSERT INTO {ENTRIES_FTS_TABLE} ({ENTRIES_FTS_TABLE}, rowid, entry)
+    VALUES ('delete', old.id, entry_plain(old.entry, old.compressed));
+    INSERT INTO {ENTRIES_FTS_TABLE} (rowid, entry) VALUES (new.id, entry_plain(new.entry, new.compressed));
+    END''')
+    cursor.execute(f"INSERT INTO {ENTRIES_FTS_TABLE} ({ENTRIES_FTS_TABLE}) VALUES ('rebuild')")
+
+
+def _add_entry_date_index(cursor: sqlite3.Cursor) -> None:
+    """ Version 8, parts of the entry date as generated columns with their own indexes, for date pattern lookups. """
+    # virtual columns are worked out from date when they're read, only the indexes store them. weekday is Monday = 0,
+    # like datetime. The ISO week belongs to the year its Thursday falls in
+    cursor.execute(f'''
+    ALTER TABLE {ENTRIES_TABLE} ADD COLUMN month_day TEXT GENERATED ALWAYS AS (substr(date, 6, 5)) VIRTUAL''')
+    cursor.execute(f'''
+    ALTER TABLE {ENTRIES_TABLE} ADD COLUMN weekday INTEGER
+    GENERATED ALWAYS AS ((CAST(strftime('%w', date) AS INTEGER) + 6) % 7) VIRTUAL''')
+    cursor.execute(f'''
+    ALTER TABLE {ENTRIES_TABLE} ADD COLUMN iso_week TEXT GENERATED ALWAYS AS (
+    strftime('%Y', date, (3 - weekday) || ' days') || '-W' ||
+    printf('%02d', (CAST(strftime('%j', date, (3 - weekday) || ' days') AS INTEGER) - 1) / 7 + 1)) VIRTUAL''')
+    # date is the second column of each, so a date range or date order is part of the same index seek
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_entries_month_day ON {ENTRIES_TABLE} (month_day, date)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_entries_weekday ON {ENTRIES_TABLE} (weekday, date)')
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_entries_iso_week ON {ENTRIES_TABLE} (iso_week, date)')
+
+
+def _drop_current_revisions(cursor: sqlite3.Cursor) -> None:
+    """ Version 9, the history only keeps texts that were replaced. The latest revision of an entry used to be a copy of
+        its current text, those copies are removed. """
+    dates = cursor.execute(f'''
+    SELECT r.entry_date, max(r.revision), entry_plain(e.entry, e.compressed) FROM {ENTRY_REVISIONS_TABLE} AS r
+    JOIN {ENTRIES_TABLE} AS e ON e.date = r.entry_date GROUP BY r.entry_date''').fetchall()
+    for date, latest, entry_text in dates:
+        rows = cursor.execute(f'''
+        SELECT snapshot, data FROM {ENTRY_REVISIONS_TABLE}
+        WHERE entry_date = ? AND revision >= (
+            SELECT max(revision) FROM {ENTRY_REVISIONS_TABLE} WHERE entry_date = ? AND snapshot)
+        ORDER BY revision''', (date, date)).fetchall()
+        text = None
+        for snapshot, data in rows:
+            text = zlib.decompress(data).decode() if snapshot else apply_delta(text, data)
+        # nothing is stored as a delta against the latest revision, so it can go on its own
+        if text == entry_text:
+            cursor.execute(f'DELETE FROM {ENTRY_REVISIONS_TABLE} WHERE entry_date = ? AND revision = ?', (date, latest))
+
+
+MIGRATIONS = [
+    _create_base_tables,
+    _index_goals_state,
+    _create_entries_search,
+    _add_entry_counts,
+    _create_goal_stats,
+    _create_entry_revisions,
+    _add_entry_compression,
+    _add_entry_date_index,
+    _drop_current_revisions,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+# returns the schema version recorded in the db file, 0 for a new or pre-versioning db
+def schema_version(connection: sqlite3.Connection) -> int:
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+# initialize the db and tables if needed, then bring the schema up to date
+def initialize_journal_db(connection: sqlite3.Connection, logger: logger) -> None:
+    """ Function responsible for initializing Journal DB and running any pending migrations. """
+    # the usual case, every connection after the first upgrade only pays for this one pragma read
+    version = schema_version(connection)
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        logger.warning('Journal DB schema version %s is newer than this app supports (%s)', version, SCHEMA_VERSION)
+        return
+
+    for target_version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        # every migration runs in its own transaction together with its user_version bump, so a failure leaves the
+        # db at the last completed version with all data intact
+        try:
+            cursor = connection.cursor()
+            # another connection may be upgrading the same db, the write lock makes this one wait and then re-check
+            cursor.execute('BEGIN IMMEDIATE')
+            if schema_version(connection) >= target_version:
+                connection.rollback()
+                continue
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {target_version}')
+            connection.commit()
+            logger.info('Migrated Journal DB to schema version %s', target_version)
+        except Exception as e:
+            connection.rollback()
+            logger.exception('Migration to schema version %s failed: %s', target_version, e)
+            raise
+        finally:
+            cursor.close()
+
+
+# recomputes the goal statistics rollups from goals_state
+def rebuild_goal_stats(cursor: sqlite3.Cursor) -> None:
+    cursor.execute(f'DELETE FROM {GOAL_STATS_MONTHLY_TABLE}')
+    cursor.execute(f'DELETE FROM {GOAL_STATS_TABLE}')
+    cursor.execute(f'''
+    INSERT INTO {GOAL_STATS_MONTHLY_TABLE} (goal_id, month, tracked_days, completed_days)
+    SELECT goal_id, substr(entry_date, 1, 7), count(*), sum(coalesce(state, 0) != 0)
+    FROM {GOALS_STATE_TABLE} GROUP BY goal_id, substr(entry_date, 1, 7)''')
+    cursor.execute(f'''
+    INSERT INTO {GOAL_STATS_TABLE} (goal_id, tracked_days, completed_days)
+    SELECT goal_id, sum(tracked_days), sum(completed_days) FROM {GOAL_STATS_MONTHLY_TABLE} GROUP BY goal_id''')
+
+    # the index on (goal_id, entry_date) returns every goal's completed days in order, one pass covers all goals
+    rows = cursor.execute(f'''
+    SELECT goal_id, entry_date FROM {GOALS_STATE_TABLE}
+    WHERE coalesce(state, 0) != 0 ORDER BY goal_id, entry_date''').fetchall()
+    completed = {}
+    for goal_id, entry_date in rows:
+        completed.setdefault(goal_id, []).append(entry_date)
+    cursor.executemany(f'''
+    UPDATE {GOAL_STATS_TABLE} SET current_streak = ?, current_streak_end = ?, best_streak = ?, best_streak_end = ?
+    WHERE goal_id = ?''', [(*streaks_from_dates(dates), goal_id) for goal_id, dates in completed.items()])
+
+
+# works out the streaks from a goal's completed dates in ascending .isoformat(). Returns
+# (current_streak, current_streak_end, best_streak, best_streak_end), the current streak being the run that ends on the
+# latest completed day
+def streaks_from_dates(dates: list[str]) -> tuple:
+    if not dates:
+        return 0, None, 0, None
+    best = run = 0
+    best_end = None
+    previous = None
+    for date in dates:
+        day = datetime.date.fromisoformat(date).toordinal()
+        run = run + 1 if previous is not None and day == previous + 1 else 1
+        previous = day
+        if run >= best:
+            best, best_end = run, date
+    return run, dates[-1], best, best_end
+
+
+# entry texts are diffed as runs of words and runs of whitespace, which join back into the exact text
+_DELTA_TOKENS = re.compile(r'\s+|\S+')
+
+
+# returns the compressed delta that turns old_text into new_text. Words kept from old_text are stored as [start, end]
+# token ranges, everything else as the new text
+def text_delta(old_text: str, new_text: str) -> bytes:
+    # difflib is only needed once an entry is saved, importing it here keeps it out of startup
+    import difflib
+    old_tokens = _DELTA_TOKENS.findall(old_text)
+    new_tokens = _DELTA_TOKENS.findall(new_text)
+    operations = []
+    for tag, old_start, old_end, new_start, new_end in difflib.SequenceMatcher(None, old_tokens, new_tokens).get_opcodes():
+        if tag == 'equal':
+            operations.append([old_start, old_end])
+        elif tag != 'delete':
+            operations.append(''.join(new_tokens[new_start:new_end]))
+    return zlib.compress(json.dumps(operations, ensure_ascii=False, separators=(',', ':')).encode())
+
+
+# rebuilds the new text from the old text and a delta from text_delta
+def apply_delta(old_text: str, delta: bytes) -> str:
+    old_tokens = _DELTA_TOKENS.findall(old_text)
+    return ''.join(''.join(old_tokens[operation[0]:operation[1]]) if isinstance(operation, list) else operation
+                   for operation in json.loads(zlib.decompress(delta)))
+
+
+# returns how an entry text is stored, (value, compressed). Long texts are compressed when that makes them smaller
+def compress_entry(entry_text: str | None, enabled: bool = None) -> tuple:
+    enabled = ENTRY_COMPRESSION if enabled is None else enabled
+    if not enabled or entry_text is None or len(entry_text) < ENTRY_COMPRESS_MIN_CHARS:
+        return entry_text, 0
+    encoded = entry_text.encode()
+    compressed = zlib.compress(encoded, ENTRY_COMPRESS_LEVEL)
+    if len(compressed) >= len(encoded):
+        return entry_text, 0
+    return compressed, 1
+
+
+# returns the text of a stored entry, whichever way it was stored. Also registered on every connection as the SQL
+# function entry_plain(entry, compressed), which the search index and the entries_text view use. Compressed entries
+# are always bytes, so text written over one without clearing the marker still reads back as is
+def decompress_entry(value, compressed: int) -> str | None:
+    if not compressed or not isinstance(value, bytes):
+        return value
+    return zlib.decompress(value).decode()
+
+
+# returns (char_count, word_count) for an entry text
+def entry_counts(entry_text: str) -> tuple:
+    if entry_text is None:
+        return 0, 0
+    return len(entry_text), len(entry_text.split())
+
 
 # retreive the db connection
 def journal_db_connection(database_name: str = DATABASE_NAME) -> sqlite3.Connection:
-    """ Function provides a sqlite3.Connection for the Journal DB. """
-    return sqlite3.connect(database_name)
+    """ Function provides a tuned sqlite3.Connection for the Journal DB. """
+    # the connection may be used by background loaders, access is serialized by the connection manager lock
+    connection = sqlite3.connect(database_name, check_same_thread=False, cached_statements=DB_STATEMENT_CACHE_SIZE)
+    connection.execute(f'PRAGMA journal_mode = {DB_JOURNAL_MODE}')
+    connection.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+    connection.execute(f'PRAGMA cache_size = {DB_CACHE_SIZE}')
+    connection.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+    connection.execute(f'PRAGMA temp_store = {DB_TEMP_STORE}')
+    # the schema refers to it, every connection needs it before touching the entries
+    connection.create_function('entry_plain', 2, decompress_entry, deterministic=True)
+    return connection
+
+
+class ConnectionManager:
+    """ Owns one connection to a journal db and the lock that serializes access to it. Repositories share a manager,
+        so the schema is checked once and all their writes go through a single commit stream. """
+
+    def __init__(self, database_name: str = DATABASE_NAME):
+        self.database_name = database_name
+        self.logger = logger.journal_logger()
+        self.lock = threading.RLock()
+        self._connection = None
+
+    # the connection is opened, and the schema brought up to date, on first use
+    @property
+    def connection(self) -> sqlite3.Connection:
+        with self.lock:
+            if self._connection is None:
+                self._connection = journal_db_connection(self.database_name)
+                initialize_journal_db(self._connection, self.logger)
+            return self._connection
+
+    # returns a separate manager for the same db, for background threads that shouldn't queue behind the UI thread
+    # on the shared lock. With WAL, its reads run alongside writes on the shared connection
+    def worker(self) -> 'ConnectionManager':
+        return ConnectionManager(self.database_name)
+
+    def close(self):
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+# process wide managers, one per db file
+_shared_managers = {}
+_shared_managers_lock = threading.Lock()
+
+
+# returns the process wide connection manager for the given db
+def shared_connection_manager(database_name: str = DATABASE_NAME) -> ConnectionManager:
+    with _shared_managers_lock:
+        manager = _shared_managers.get(database_name)
+        if manager is None:
+            manager = _shared_managers[database_name] = ConnectionManager(database_name)
+        return manager
+
+
+# closes every shared connection, to be called when the app exits
+def close_shared_connections():
+    with _shared_managers_lock:
+        for manager in _shared_managers.values():
+            manager.close()
+        _shared_managers.clear()
+
+
+class PoolExhausted(Exception):
+    """ Raised when no pooled connection is free within the timeout. """
+
+
+class ConnectionPool:
+    """ A fixed number of connection managers for one db, lent out to request threads one at a time. Managers are
+        only opened when they are first needed, and the most recently returned one is lent out next, so a quiet pool
+        keeps using the same warm connection. """
+
+    def __init__(self, database_name: str = DATABASE_NAME, size: int = 4):
+        self.database_name = database_name
+        self.size = size
+        self.available = queue.LifoQueue()
+        for _ in range(size):
+            self.available.put(None)
+
+    # lends a manager for the duration of a 'with' block, waiting up to timeout seconds for one to be free
+    @contextmanager
+    def acquire(self, timeout: float = None):
+        try:
+            manager = self.available.get(timeout=timeout)
+        except queue.Empty:
+            raise PoolExhausted(f'No free connection to {self.database_name} after {timeout}s') from None
+        if manager is None:
+            manager = ConnectionManager(self.database_name)
+        try:
+            yield manager
+        finally:
+            self.available.put(manager)
+
+    # closes the connections that are not lent out, to be called once the pool is no longer used
+    def close(self):
+        for _ in range(self.size):
+            try:
+                manager = self.available.get_nowait()
+            except queue.Empty:
+                break
+            if manager is not None:
+                manager.close()
+
+
+class QueryStats:
+    """ Per statement timing for everything that runs through BaseRepository.execute. Statements are grouped by their
+        SQL text, which only ever holds placeholders, so each group is one statement shape. When disabled, execute
+        skips it entirely. """
+
+    def __init__(self, enabled: bool = QUERY_STATS_ENABLED, slow_query_ms: float = QUERY_SLOW_MS,
+                 sample_size: int = QUERY_STATS_SAMPLES):
+        self.logger = logger.journal_logger()
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.sample_size = sample_size
+        self.lock = threading.Lock()
+        # {statement: [calls, total seconds, rows returned, rows affected, deque of recent timings]}
+        self.statements = {}
+
+    def record(self, query: str, seconds: float, rows_returned: int, rows_affected: int):
+        statement = ' '.join(query.split())
+        with self.lock:
+            stats = self.statements.get(statement)
+            if stats is None:
+                stats = self.statements[statement] = [0, 0.0, 0, 0, deque(maxlen=self.sample_size)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += rows_returned
+            stats[3] += rows_affected
+            stats[4].append(seconds)
+
+    # logs a slow statement with its query plan, runs on the connection that ran the statement
+    def log_slow_query(self, connection: sqlite3.Connection, query: str, values, seconds: float):
+        try:
+            plan = connection.execute(f'EXPLAIN QUERY PLAN {query}', values).fetchall()
+            plan_text = '; '.join(row[-1] for row in plan)
+        except sqlite3.Error as e:
+            plan_text = f'unavailable ({e})'
+        self.logger.warning('Slow query (%.1f ms): %s | plan: %s', seconds * 1000, ' '.join(query.split()), plan_text)
+
+    # returns the stats for every statement, the slowest in total first
+    def snapshot(self) -> list[dict]:
+        with self.lock:
+            items = [(statement, stats[:4], sorted(stats[4])) for statement, stats in self.statements.items()]
+        results = []
+        for statement, (calls, total, rows_returned, rows_affected), timings in items:
+            results.append({
+                'statement': statement,
+                'calls': calls,
+                'total_ms': total * 1000,
+                'mean_ms': total * 1000 / calls,
+                'p50_ms': _percentile(timings, 0.50) * 1000,
+                'p95_ms': _percentile(timings, 0.95) * 1000,
+                'p99_ms': _percentile(timings, 0.99) * 1000,
+                'rows_returned': rows_returned,
+                'rows_affected': rows_affected,
+            })
+        results.sort(key=lambda result: result['total_ms'], reverse=True)
+        return results
+
+    # returns a plain text table of the stats
+    def report(self) -> str:
+        lines = [f'{"calls":>7} {"total ms":>10} {"p50 ms":>8} {"p95 ms":>8} {"rows":>8}  statement']
+        for result in self.snapshot():
+            rows = result['rows_returned'] + result['rows_affected']
+            lines.append(f'{result["calls"]:>7} {result["total_ms"]:>10.2f} {result["p50_ms"]:>8.3f} '
+                         f'{result["p95_ms"]:>8.3f} {rows:>8}  {result["statement"][:120]}')
+        return '\n'.join(lines)
+
+    # writes the stats as JSON
+    def dump(self, path: str = QUERY_STATS_FILE):
+        output = pathlib.Path(path)
+        output.parent.mkdir(parents=True, exist_ok=True)
+        output.write_text(json.dumps(self.snapshot(), indent=2))
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+
+
+# percentile of an already sorted list of timings
+def _percentile(timings: list, fraction: float) -> float:
+    if not timings:
+        return 0.0
+    return timings[min(int(len(timings) * fraction), len(timings) - 1)]
+
+
+# the process wide stats every repository records into
+query_stats = QueryStats()
+
+
+# writes the stats when the app exits, if they were collected
+@atexit.register
+def _dump_query_stats_on_exit():
+    if query_stats.enabled and query_stats.statements:
+        query_stats.dump()
+        query_stats.logger.info('Query stats written to %s', QUERY_STATS_FILE)
+
+
+class _LogValues:
+    """ Wraps statement values for the debug log. Long strings such as entry texts are cut short, and only when the
+        log record is actually formatted. """
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __str__(self) -> str:
+        return str(self._shorten(self.values))
+
+    def _shorten(self, value):
+        if isinstance(value, str) and len(value) > LOG_VALUE_MAX_LENGTH:
+            return f'{value[:LOG_VALUE_MAX_LENGTH]}...<{len(value)} chars>'
+        if isinstance(value, (list, tuple)):
+            if len(value) > 10:
+                return [self._shorten(item) for item in value[:10]] + [f'...<{len(value)} items>']
+            return [self._shorten(item) for item in value]
+        return value
 
 
 class BaseRepository:
-    # parent class for the other repositories
+    # parent class for the other repositories. Without a connection manager the process wide one is used
  
-    def __init__(self):
+    def __init__(self, connection_manager: ConnectionManager = None):
         self.logger = logger.journal_logger()
-        self.conn = journal_db_connection()
-        initialize_journal_db(self.conn, self.logger)
+        self.manager = connection_manager if connection_manager is not None else shared_connection_manager()
+        self.lock = self.manager.lock
+
+    # the connection is only opened by the first statement, so building repositories doesn't touch the db
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self.manager.connection
 
-    # connection manager, to be used in 'with' statements
+    # connection manager, to be used in 'with' statements. The lock keeps background loaders and the UI thread
+    # from interleaving statements on the same connection
     @contextmanager
     def cursor(self):
-        cursor = self.conn.cursor()
-        try:
-            yield cursor
-            self.conn.commit()
-        except sqlite3.IntegrityError as e:
-            self.conn.rollback()
-            self.logger.exception('SQLite error: %s', e)
-        except Exception as e:
-            self.conn.rollback()
-            self.logger.exception('Error at: %s', e)
-            raise
-        finally:
-            cursor.close()
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                yield cursor
+                self.conn.commit()
+            except sqlite3.IntegrityError as e:
+                self.conn.rollback()
+                self.logger.exception('SQLite error: %s', e)
+            except Exception as e:
+                self.conn.rollback()
+                self.logger.exception('Error at: %s', e)
+                raise
+            finally:
+                cursor.close()
+
+    # runs a statement on a cursor from self.cursor(). many runs it with executemany, fetch returns the result rows.
+    # Every statement goes through here, so it's also where query stats are recorded
+    def execute(self, cursor: sqlite3.Cursor, query: str, values=(), many: bool = False, fetch: bool = False):
+        if not query_stats.enabled:
+            if many:
+                cursor.executemany(query, values)
+            else:
+                cursor.execute(query, values)
+            return cursor.fetchall() if fetch else None
+
+        start = time.perf_counter()
+        if many:
+            cursor.executemany(query, values)
+        else:
+            cursor.execute(query, values)
+        rows = cursor.fetchall() if fetch else None
+        elapsed = time.perf_counter() - start
+
+        query_stats.record(query, elapsed, len(rows) if fetch else 0, max(cursor.rowcount, 0))
+        if elapsed * 1000 >= query_stats.slow_query_ms:
+            plan_values = values[0] if many and values else values
+            query_stats.log_slow_query(cursor.connection, query, plan_values, elapsed)
+        return rows
 
     # basic insert function. Does not return anything. Takes a list of the columns needed, and a list of tuples
     def insert(self, table: str, columns: list, values: list[tuple]):
@@ -86,9 +690,29 @@ class BaseRepository:
         placeholders = ', '.join(['?'] * len(columns))
         query = f'INSERT INTO {table} ({columns_str}) VALUES ({placeholders})'
 
-        self.logger.debug('Inserting with query: %s, and values %s', query, values)
+        self.logger.debug('Inserting with query: %s, and values %s', query, _LogValues(values))
         with self.cursor() as cursor:
-            cursor.executemany(query, values)
+            self.execute(cursor, query, values, many=True)
+
+    # basic upsert function. Inserts the rows, and for rows that clash on conflict_columns (which must match a unique
+    # index) updates the remaining columns instead. Pass a cursor to run it inside a transaction that is already open
+    def upsert(self, table: str, columns: list, values: list[tuple], conflict_columns: list, cursor: sqlite3.Cursor = None):
+        columns_str = ', '.join(columns)
+        placeholders = ', '.join(['?'] * len(columns))
+        update_columns = [column for column in columns if column not in conflict_columns]
+        if update_columns:
+            action = 'DO UPDATE SET ' + ', '.join([f'{column} = excluded.{column}' for column in update_columns])
+        else:
+            action = 'DO NOTHING'
+        query = (f'INSERT INTO {table} ({columns_str}) VALUES ({placeholders}) '
+                 f'ON CONFLICT ({", ".join(conflict_columns)}) {action}')
+
+        self.logger.debug('Upserting with query: %s, and values %s', query, _LogValues(values))
+        if cursor is not None:
+            self.execute(cursor, query, values, many=True)
+            return
+        with self.cursor() as cursor:
+            self.execute(cursor, query, values, many=True)
 
     # basic select function. Returns all the results as a list. Takes a list of columns and a dictionary of conditions.
     # conditions should be in the format of column: condition
@@ -113,25 +737,46 @@ class BaseRepository:
                 values += tuple(conditions_range[key])
 
         self.logger.debug('selecting with query: SELECT %s FROM %s %s, and values %s',
-                          columns_str, table, where_clause, values)
+                          columns_str, table, where_clause, _LogValues(values))
 
         with self.cursor() as cursor:
-            cursor.execute(
-            f'SELECT {columns_str} FROM {table} {where_clause}', values
-        )
-            results = cursor.fetchall()
+            results = self.execute(cursor, f'SELECT {columns_str} FROM {table} {where_clause}', values, fetch=True)
         return results
 
+    # yields every row of a table a page at a time, ordered by key_columns, which must be in columns and match a unique
+    # index. Each page is its own query starting after the last key of the page before (keyset pagination), so the lock
+    # is only held per page and memory stays at one page however big the table is
+    def select_pages(self, table: str, columns: list, key_columns: list, page_size: int):
+        columns_str = ', '.join(columns)
+        keys_str = ', '.join(key_columns)
+        placeholders = ', '.join(['?'] * len(key_columns))
+        first_query = f'SELECT {columns_str} FROM {table} ORDER BY {keys_str} LIMIT ?'
+        next_query = f'SELECT {columns_str} FROM {table} WHERE ({keys_str}) > ({placeholders}) ORDER BY {keys_str} LIMIT ?'
+        key_positions = [columns.index(column) for column in key_columns]
+
+        last_key = None
+        while True:
+            with self.cursor() as cursor:
+                if last_key is None:
+                    rows = self.execute(cursor, first_query, (page_size,), fetch=True)
+                else:
+                    rows = self.execute(cursor, next_query, (*last_key, page_size), fetch=True)
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            last_key = tuple(rows[-1][position] for position in key_positions)
+
     # basic delete function. takes a table name as a string, and takes a dictionary of conditions {column_name: condtition}
     def delete(self, table: str, conditions: dict):
         where_clause = ' AND '.join([f'{key} = ?' for key in conditions.keys()])
         values = tuple(conditions.values())
 
         self.logger.debug('deleting with query: DELETE FROM %s WHERE %s, and values %s',
-                          table, where_clause, values)
+                          table, where_clause, _LogValues(values))
 
         with self.cursor() as cursor:
-            cursor.execute(f'DELETE FROM {table} WHERE {where_clause}', values)
+            self.execute(cursor, f'DELETE FROM {table} WHERE {where_clause}', values)
 
     # basic update function
     def update(self, table: str, conditions: dict, data: dict):
@@ -139,16 +784,16 @@ class BaseRepository:
         where_clause = ' AND '.join([f'{key} = ?' for key in conditions.keys()])
         values = tuple(data.values()) + tuple(conditions.values())
 
-        self.logger.debug('updating with query: UPDATE % SET %s WHERE %s, and values %s',
-                          table, set_clause, where_clause, values)
+        self.logger.debug('updating with query: UPDATE %s SET %s WHERE %s, and values %s',
+                          table, set_clause, where_clause, _LogValues(values))
 
         with self.cursor() as cursor:
-            cursor.execute(f'UPDATE {table} SET {set_clause} WHERE {where_clause}', values)
+            self.execute(cursor, f'UPDATE {table} SET {set_clause} WHERE {where_clause}', values)
 
 
 class GoalsRepository(BaseRepository):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, connection_manager: ConnectionManager = None):
+        super().__init__(connection_manager)
         self.goals_table = GOALS_TABLE
         self.goals_state_table = GOALS_STATE_TABLE
         
@@ -157,6 +802,15 @@ class GoalsRepository(BaseRepository):
     def add_new_goal(self, description):
         self.insert(self.goals_table, ['goal_description'], [(description,)])
 
+    # adds the goals that don't exist yet, returns {description: goal_id} for every description given
+    def add_goals(self, descriptions: list) -> dict:
+        with self.cursor() as cursor:
+            self.upsert(self.goals_table, ['goal_description'], [(description,) for description in descriptions],
+                        ['goal_description'], cursor)
+            rows = self.execute(cursor, f'SELECT id, goal_description FROM {self.goals_table}', fetch=True)
+        wanted = set(descriptions)
+        return {description: goal_id for goal_id, description in rows if description in wanted}
+
     # updates the selected goal
     def edit_goal(self, old_goal, new_goal):
         self.update(self.goals_table, {'goal_description': old_goal}, {'goal_description': new_goal})
@@ -166,20 +820,30 @@ class GoalsRepository(BaseRepository):
         goals = self.select(self.goals_table)
         return goals
 
-    # deletes a specified goal
+    # deletes a specified goal, with its statistics
     def delete_goal(self, goal_id: int):
-        self.delete(self.goals_table, {'id': goal_id})
+        with self.cursor() as cursor:
+            self.execute(cursor, f'DELETE FROM {self.goals_table} WHERE id = ?', (goal_id,))
+            self.execute(cursor, f'DELETE FROM {GOAL_STATS_MONTHLY_TABLE} WHERE goal_id = ?', (goal_id,))
+            self.execute(cursor, f'DELETE FROM {GOAL_STATS_TABLE} WHERE goal_id = ?', (goal_id,))
 
-    # adding goal states to the goal_states table. Takes a date and a dictionary of {goal_id: state}
+    # adding goal states to the goal_states table. Takes a date and a dictionary of {goal_id: state}.
+    # states that already exist for the date are overwritten
     def add_goal_states(self, entry_date: datetime, goals: dict):
         formatted_date = entry_date.isoformat()
-        columns = ['entry_date', 'goal_id', 'state']
-        values = []
-        for goal in goals:
-            value = (formatted_date, goal, goals[goal])
-            values.append(value)
+        values = [(formatted_date, goal_id, state) for goal_id, state in goals.items()]
+        self.upsert_goal_states(values)
 
-        self.insert(self.goals_state_table, columns, values)
+    # inserts or updates many goal states at once, takes a list of (formatted_date, goal_id, state) tuples.
+    # Pass a cursor to make it part of a larger transaction
+    def upsert_goal_states(self, values: list[tuple], cursor: sqlite3.Cursor = None):
+        if cursor is None:
+            with self.cursor() as cursor:
+                self.upsert_goal_states(values, cursor)
+            return
+        self.upsert(self.goals_state_table, ['entry_date', 'goal_id', 'state'], values,
+                    ['entry_date', 'goal_id'], cursor)
+        self._update_streaks(cursor, values)
 
     # get the goals state of completion for the specific date
     def get_goal_states(self, date: datetime) -> list[tuple]:
@@ -190,40 +854,154 @@ class GoalsRepository(BaseRepository):
     # delete the goal states for the given date
     def delete_goal_states(self, date: datetime):
         formatted_date = date.isoformat()
-        self.delete(self.goals_state_table, {'entry_date': formatted_date})
+        with self.cursor() as cursor:
+            goal_ids = self.execute(cursor, f'SELECT goal_id FROM {self.goals_state_table} WHERE entry_date = ?',
+                                    (formatted_date,), fetch=True)
+            self.execute(cursor, f'DELETE FROM {self.goals_state_table} WHERE entry_date = ?', (formatted_date,))
+            # a deleted state counts the same as an unticked one for the streaks
+            self._update_streaks(cursor, [(formatted_date, goal_id, 0) for (goal_id,) in goal_ids])
 
     # edit goal states. takes a date, and dictionary with {goal_id: state}
     def edit_goal_states(self, date: datetime, new_states: dict):
         formatted_date = date.isoformat()
+        values = [(state, formatted_date, goal_id) for goal_id, state in new_states.items()]
+        with self.cursor() as cursor:
+            self.execute(cursor, f'UPDATE {self.goals_state_table} SET state = ? WHERE entry_date = ? AND goal_id = ?',
+                         values, many=True)
+            # only states that exist are updated, the rest don't touch the streaks
+            existing = {goal_id for (goal_id,) in self.execute(
+                cursor, f'SELECT goal_id FROM {self.goals_state_table} WHERE entry_date = ?', (formatted_date,), fetch=True)}
+            self._update_streaks(cursor, [(formatted_date, goal_id, state) for goal_id, state in new_states.items()
+                                          if goal_id in existing])
+
+    # returns the statistics of every goal, [(goal_id, description, tracked_days, completed_days, current_streak,
+    # current_streak_end, best_streak, best_streak_end)]. Goals without any state get zeros. These are kept up to date on
+    # every write, nothing is counted here
+    def get_goal_stats(self) -> list[tuple]:
+        query = f'''
+        SELECT g.id, g.goal_description, coalesce(s.tracked_days, 0), coalesce(s.completed_days, 0),
+        coalesce(s.current_streak, 0), s.current_streak_end, coalesce(s.best_streak, 0), s.best_streak_end
+        FROM {self.goals_table} AS g LEFT JOIN {GOAL_STATS_TABLE} AS s ON s.goal_id = g.id
+        ORDER BY g.id'''
+        with self.cursor() as cursor:
+            rows = self.execute(cursor, query, fetch=True)
+        return rows
+
+    # returns the per month statistics of a goal between two months ('YYYY-MM'), [(month, tracked_days, completed_days)]
+    def get_monthly_goal_stats(self, goal_id: int, first_month: str, last_month: str) -> list[tuple]:
+        return self.select(GOAL_STATS_MONTHLY_TABLE, ['month', 'tracked_days', 'completed_days'],
+                           conditions={'goal_id': goal_id}, conditions_range={'month': (first_month, last_month)})
+
+    # recomputes all goal statistics from goals_state, to repair them
+    def rebuild_goal_stats(self):
+        self.logger.info('Rebuilding the goal statistics')
         with self.cursor() as cursor:
-            for goal_id in new_states:
-                set_clause = 'state = ?'
-                where_clause = 'entry_date = ? AND goal_id = ?'
-                values = (new_states[goal_id], formatted_date, goal_id)
-                cursor.execute(f'UPDATE {self.goals_state_table} SET {set_clause} WHERE {where_clause}', values)
+            rebuild_goal_stats(cursor)
 
-    # get the goal states for the entire month
+    # keeps the streaks in goal_stats in step with goal state changes, [(formatted_date, goal_id, state)]. Runs in the
+    # transaction of the write. A day that extends or sits inside the latest run is applied directly, anything that
+    # could split or join runs before it recomputes that goal from its history
+    def _update_streaks(self, cursor: sqlite3.Cursor, changes: list[tuple]):
+        changes_by_goal = {}
+        for date, goal_id, state in changes:
+            changes_by_goal.setdefault(goal_id, []).append((date, state))
+
+        for goal_id, goal_changes in changes_by_goal.items():
+            rows = self.execute(cursor, f'''
+            SELECT current_streak, current_streak_end, best_streak, best_streak_end FROM {GOAL_STATS_TABLE}
+            WHERE goal_id = ?''', (goal_id,), fetch=True)
+            if not rows:
+                continue
+            current, current_end, best, best_end = rows[0]
+            end = datetime.date.fromisoformat(current_end).toordinal() if current_end else None
+            best_end_day = datetime.date.fromisoformat(best_end).toordinal() if best_end else None
+
+            recompute = False
+            for date, state in sorted(goal_changes):
+                day = datetime.date.fromisoformat(date).toordinal()
+                if state:
+                    if end is not None and day <= end:
+                        if day > end - current:
+                            # already part of the latest run
+                            continue
+                        recompute = True
+                        break
+                    # the latest run only continues when the new day directly follows it
+                    current = current + 1 if end is not None and day == end + 1 else 1
+                    end = day
+                    if current >= best:
+                        best, best_end_day = current, end
+                else:
+                    in_current = end is not None and end - current < day <= end
+                    in_best = best_end_day is not None and best_end_day - best < day <= best_end_day
+                    if in_current or in_best:
+                        recompute = True
+                        break
+
+            if recompute:
+                dates = [row[0] for row in self.execute(cursor, f'''
+                SELECT entry_date FROM {self.goals_state_table}
+                WHERE goal_id = ? AND coalesce(state, 0) != 0 ORDER BY entry_date''', (goal_id,), fetch=True)]
+                streaks = streaks_from_dates(dates)
+            else:
+                streaks = (current, datetime.date.fromordinal(end).isoformat() if end is not None else None,
+                           best, datetime.date.fromordinal(best_end_day).isoformat() if best_end_day is not None else None)
+            self.execute(cursor, f'''
+            UPDATE {GOAL_STATS_TABLE} SET current_streak = ?, current_streak_end = ?, best_streak = ?, best_streak_end = ?
+            WHERE goal_id = ?''', (*streaks, goal_id))
+
+    # get every goal with its states between two dates in one query, returns [(goal_id, description, entry_date, state)]
+    # ordered by goal. Goals without any state in the range come back once with entry_date and state as None
+    def get_states_range(self, first_day: str, last_day: str) -> list[tuple]:
+        query = f'''
+        SELECT g.id, g.goal_description, gs.entry_date, gs.state FROM {self.goals_table} AS g
+        LEFT JOIN {self.goals_state_table} AS gs ON gs.goal_id = g.id AND gs.entry_date BETWEEN ? AND ?
+        ORDER BY g.id'''
+        values = (first_day, last_day)
+
+        self.logger.debug('selecting goal states range with query: %s, and values %s', query, values)
+        with self.cursor() as cursor:
+            rows = self.execute(cursor, query, values, fetch=True)
+        return rows
+
+    # yields every goal a page at a time, [(id, goal_description)]
+    def iter_goals(self, page_size: int = TRANSFER_PAGE_SIZE):
+        return self.select_pages(self.goals_table, ['id', 'goal_description'], ['id'], page_size)
+
+    # yields every goal state ordered by date a page at a time, [(entry_date, goal_id, state)]
+    def iter_goal_states(self, page_size: int = TRANSFER_PAGE_SIZE):
+        return self.select_pages(self.goals_state_table, ['entry_date', 'goal_id', 'state'], ['entry_date', 'goal_id'],
+                                 page_size)
+
+    # get the goal states for the entire month, returns [(entry_date, goal_id, state)]
     def get_monthly_states(self, first_day, last_day) -> list[tuple]:
-        states = self.select(self.goals_state_table, ['goal_id', 'state'],
+        states = self.select(self.goals_state_table, ['entry_date', 'goal_id', 'state'],
                              conditions_range={'entry_date': (first_day, last_day)})
         return states
 
 
 class EntriesRepository(BaseRepository):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, connection_manager: ConnectionManager = None):
+        super().__init__(connection_manager)
         self.entries_table = ENTRIES_TABLE
+        self.search_table = ENTRIES_FTS_TABLE
+        self.revisions_table = ENTRY_REVISIONS_TABLE
         
        
     # adds a new entry to the table, takes a datetime.date() object
     def add_entry(self, date: datetime, entry_text: str):
         formatted_date = date.isoformat()
-        self.insert(self.entries_table, ['date', 'entry'], [(formatted_date, entry_text)])
+        with self.cursor() as cursor:
+            self._record_revisions(cursor, [(formatted_date, entry_text)])
+            self.execute(cursor, f'''
+            INSERT INTO {self.entries_table} (date, entry, compressed, char_count, word_count)
+            VALUES (?, ?, ?, ?, ?)''', (formatted_date, *compress_entry(entry_text), *entry_counts(entry_text)))
 
     # gets the specified dates entry, takes a datetime.date() object
     def get_entry(self, date: datetime):
         formatted_date = date.isoformat()
-        entry = self.select(self.entries_table, conditions={'date': formatted_date})
+        entry = self.select(self.entries_table, ['id', 'date', 'entry_plain(entry, compressed)', 'char_count', 'word_count'],
+                            conditions={'date': formatted_date})
         return entry
 
     # deletes the specified dates entry, takes a datetime.date() object
@@ -234,10 +1012,339 @@ class EntriesRepository(BaseRepository):
     # edits the entry for a specified date
     def edit_entry(self, date: datetime, entry_text: str):
         formatted_date = date.isoformat()
-        self.update(self.entries_table, {'date': formatted_date}, {'entry': entry_text})
+        with self.cursor() as cursor:
+            if not self.execute(cursor, f'SELECT 1 FROM {self.entries_table} WHERE date = ?', (formatted_date,), fetch=True):
+                return
+            self._record_revisions(cursor, [(formatted_date, entry_text)])
+            self.execute(cursor, f'''
+            UPDATE {self.entries_table} SET entry = ?, compressed = ?, char_count = ?, word_count = ?
+            WHERE date = ?''', (*compress_entry(entry_text), *entry_counts(entry_text), formatted_date))
+
+    # returns only the text of the specified dates entry, or None if there isn't one
+    def get_entry_text(self, date: datetime) -> str | None:
+        rows = self.select(self.entries_table, ['entry_plain(entry, compressed)'], conditions={'date': date.isoformat()})
+        return rows[0][0] if rows else None
+
+    # adds the entry, or replaces the text if the date already has one
+    def save_entry(self, date: datetime, entry_text: str):
+        self.upsert_entries([(date.isoformat(), entry_text)])
+
+    # inserts or updates many entries at once, takes a list of (formatted_date, entry_text) tuples.
+    # Pass a cursor to make it part of a larger transaction. With revisions False the replaced texts aren't kept in the
+    # history, for bulk writes like imports
+    def upsert_entries(self, values: list[tuple], cursor: sqlite3.Cursor = None, revisions: bool = True):
+        if cursor is None:
+            with self.cursor() as cursor:
+                self.upsert_entries(values, cursor, revisions)
+            return
+        if revisions:
+            self._record_revisions(cursor, values)
+        rows = [(date, *compress_entry(entry_text), *entry_counts(entry_text)) for date, entry_text in values]
+        self.upsert(self.entries_table, ['date', 'entry', 'compressed', 'char_count', 'word_count'], rows, ['date'],
+                    cursor)
+
+    # returns the earlier texts of a date's entry, oldest first, [(revision, created, char_count)]. The current text is
+    # only in the entries table. created is .isoformat(timespec='seconds') of when the revision was stored
+    def get_revisions(self, date: datetime) -> list[tuple]:
+        with self.cursor() as cursor:
+            rows = self.execute(cursor, f'''
+            SELECT revision, created, char_count FROM {self.revisions_table} WHERE entry_date = ?
+            ORDER BY revision''', (date.isoformat(),), fetch=True)
+        return rows
+
+    # returns the text of one revision of a date's entry, or None if there is no such revision
+    def get_revision_text(self, date: datetime, revision: int) -> str | None:
+        with self.cursor() as cursor:
+            return self._revision_text(cursor, date.isoformat(), revision)
+
+    # returns the changes between two revisions of a date's entry as unified diff lines
+    def diff_revisions(self, date: datetime, old_revision: int, new_revision: int) -> list[str]:
+        import difflib
+        with self.cursor() as cursor:
+            old_text = self._revision_text(cursor, date.isoformat(), old_revision)
+            new_text = self._revision_text(cursor, date.isoformat(), new_revision)
+        if old_text is None or new_text is None:
+            raise ValueError(f'{date} has no revision {old_revision if old_text is None else new_revision}')
+        return list(difflib.unified_diff(old_text.splitlines(), new_text.splitlines(), f'revision {old_revision}',
+                                         f'revision {new_revision}', lineterm=''))
+
+    # makes an earlier revision the entry's text again. The text it replaces is kept as a new revision, so the restore
+    # can be undone
+    def restore_revision(self, date: datetime, revision: int):
+        with self.cursor() as cursor:
+            text = self._revision_text(cursor, date.isoformat(), revision)
+            if text is None:
+                raise ValueError(f'{date} has no revision {revision}')
+            self.upsert_entries([(date.isoformat(), text)], cursor)
+
+    # thins out the history. Of the revisions started more than older_than_days ago, only the last one of each day
+    # is kept, and the latest revision of an entry is always kept. Returns the number of revisions removed
+    def compact_revisions(self, older_than_days: int = REVISION_COMPACT_AFTER_DAYS) -> int:
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=older_than_days)).isoformat(timespec='seconds')
+        removed = 0
+        with self.cursor() as cursor:
+            dates = self.execute(cursor, f'''
+            SELECT entry_date FROM {self.revisions_table} WHERE created < ?
+            GROUP BY entry_date HAVING count(*) > 1''', (cutoff,), fetch=True)
+            for (date,) in dates:
+                rows = self.execute(cursor, f'''
+                SELECT revision, created, snapshot, data FROM {self.revisions_table} WHERE entry_date = ?
+                ORDER BY revision''', (date,), fetch=True)
+                revisions = []
+                text = None
+                for revision, created, snapshot, data in rows:
+                    text = zlib.decompress(data).decode() if snapshot else apply_delta(text, data)
+                    revisions.append((revision, created, text))
+
+                kept = []
+                for index, (revision, created, text) in enumerate(revisions):
+                    following = revisions[index + 1] if index + 1 < len(revisions) else None
+                    if (following is None or created >= cutoff or following[1] >= cutoff
+                            or following[1][:10] != created[:10]):
+                        kept.append((revision, created, text))
+                if len(kept) == len(revisions):
+                    continue
+
+                # the kept revisions are stored again as one chain, their numbers don't change
+                self.execute(cursor, f'DELETE FROM {self.revisions_table} WHERE entry_date = ?', (date,))
+                previous_text = None
+                for revision, created, text in kept:
+                    self._write_revision(cursor, date, revision, previous_text, text, created)
+                    previous_text = text
+                removed += len(revisions) - len(kept)
+        self.logger.info('Compacted the entry revisions, removed %s', removed)
+        return removed
+
+    # returns (revisions, stored bytes, bytes full copies of every revision would take), to see how well the deltas do
+    def revision_storage(self) -> tuple:
+        with self.cursor() as cursor:
+            rows = self.execute(cursor, f'''
+            SELECT count(*), coalesce(sum(length(data)), 0), coalesce(sum(char_count), 0)
+            FROM {self.revisions_table}''', fetch=True)
+        return rows[0]
+
+    # adds the texts that entries are about to replace to their revision history, takes the new texts as
+    # [(formatted_date, entry_text)]. Runs in the transaction of the write, before the entries table is changed. The
+    # current text is never stored here, so every entry is only kept once
+    def _record_revisions(self, cursor: sqlite3.Cursor, values: list[tuple]):
+        if not REVISIONS_ENABLED:
+            return
+        now = datetime.datetime.now()
+        for date, entry_text in values:
+            if entry_text is None:
+                continue
+            saved = self.execute(cursor, f'SELECT entry_plain(entry, compressed) FROM {self.entries_table} WHERE date = ?',
+                                 (date,), fetch=True)
+            replaced_text = saved[0][0] if saved else None
+            if replaced_text is None or replaced_text == entry_text:
+                continue
+            rows = self.execute(cursor, f'''
+            SELECT revision, created FROM {self.revisions_table} WHERE entry_date = ?
+            ORDER BY revision DESC LIMIT 1''', (date,), fetch=True)
+            latest, base_text = 0, None
+            if rows:
+                latest, created = rows[0]
+                if (now - datetime.datetime.fromisoformat(created)).total_seconds() < REVISION_MERGE_SECONDS:
+                    # saves close together, like autosaves while typing, only keep the text from before the first one
+                    continue
+                base_text = self._revision_text(cursor, date, latest)
+            self._write_revision(cursor, date, latest + 1, base_text, replaced_text, now.isoformat(timespec='seconds'))
+
+    # stores one revision, as a delta against base_text or, for the first revision, every REVISION_SNAPSHOT_INTERVAL
+    # revisions and whenever the delta wouldn't be smaller, as a compressed full copy. Replaces the revision if it exists
+    def _write_revision(self, cursor: sqlite3.Cursor, date: str, revision: int, base_text: str | None, text: str,
+                        created: str):
+        data = zlib.compress(text.encode())
+        is_snapshot = True
+        if base_text is not None:
+            deltas = self.execute(cursor, f'''
+            SELECT count(*) FROM {self.revisions_table} WHERE entry_date = ? AND revision < ? AND revision > (
+                SELECT max(revision) FROM {self.revisions_table} WHERE entry_date = ? AND snapshot AND revision < ?)''',
+                                  (date, revision, date, revision), fetch=True)[0][0]
+            if deltas + 1 < REVISION_SNAPSHOT_INTERVAL:
+                delta = text_delta(base_text, text)
+                if len(delta) < len(data):
+                    data, is_snapshot = delta, False
+        self.execute(cursor, f'''
+        INSERT INTO {self.revisions_table} (entry_date, revision, created, snapshot, data, char_count)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (entry_date, revision) DO UPDATE SET
+        snapshot = excluded.snapshot, data = excluded.data, char_count = excluded.char_count''',
+                     (date, revision, created, is_snapshot, data, len(text)))
+
+    # rebuilds one revision's text from the full copy before it and the deltas in between
+    def _revision_text(self, cursor: sqlite3.Cursor, date: str, revision: int) -> str | None:
+        rows = self.execute(cursor, f'''
+        SELECT revision, snapshot, data FROM {self.revisions_table}
+        WHERE entry_date = ? AND revision <= ? AND revision >= (
+            SELECT max(revision) FROM {self.revisions_table} WHERE entry_date = ? AND snapshot AND revision <= ?)
+        ORDER BY revision''', (date, revision, date, revision), fetch=True)
+        if not rows or rows[-1][0] != revision:
+            return None
+        text = None
+        for _, snapshot, data in rows:
+            text = zlib.decompress(data).decode() if snapshot else apply_delta(text, data)
+        return text
+
+    # yields every entry ordered by date a page at a time, [(date, entry)]
+    def iter_entries(self, page_size: int = TRANSFER_PAGE_SIZE):
+        return self.select_pages(self.entries_table, ['date', 'entry_plain(entry, compressed)'], ['date'], page_size)
 
     # gets the entries for the entire given month
     def get_monthly_entries(self, first_day, last_day) -> list[tuple]:
-        entries = self.select(self.entries_table, ['date', 'entry'], conditions_range={'date': (first_day, last_day)})
+        entries = self.select(self.entries_table, ['date', 'entry_plain(entry, compressed)'],
+                              conditions_range={'date': (first_day, last_day)})
         return entries
 
+    # gets everything the month view needs in one query. Entry rows and goal state rows (joined with their descriptions)
+    # come back through a single UNION ALL, and are folded into
+    # {day_num: [(char_count, word_count), {goal_id: (description, state)}]}. The entry texts themselves aren't loaded,
+    # get_entry_text fetches one when a day is opened
+    def get_month_snapshot(self, first_day: str, last_day: str) -> dict[int, list]:
+        query = f'''
+        SELECT date, char_count, word_count, NULL, NULL, NULL FROM {self.entries_table}
+        WHERE date BETWEEN ? AND ?
+        UNION ALL
+        SELECT gs.entry_date, NULL, NULL, gs.goal_id, g.goal_description, gs.state FROM {GOALS_STATE_TABLE} AS gs
+        JOIN {GOALS_TABLE} AS g ON g.id = gs.goal_id
+        WHERE gs.entry_date BETWEEN ? AND ?'''
+        values = (first_day, last_day, first_day, last_day)
+
+        self.logger.debug('selecting month snapshot with query: %s, and values %s', query, values)
+        with self.cursor() as cursor:
+            rows = self.execute(cursor, query, values, fetch=True)
+
+        days = {}
+        for date, char_count, word_count, goal_id, description, state in rows:
+            # dates are stored as .isoformat() strings, so the day number is always the last two characters
+            day = days.get(date)
+            if day is None:
+                day = days[date] = [None, {}]
+            if goal_id is None:
+                day[0] = (char_count, word_count)
+            else:
+                day[1][goal_id] = (description, state)
+        return {int(date[8:10]): day for date, day in days.items()}
+
+    # the entries written on the same day of the year in earlier years, newest first, [(date, text)]. On 28 February of a
+    # year without a 29th, entries from 29 February are included too. years limits how many years back it looks
+    def get_on_this_day(self, date: datetime, years: int = None) -> list[tuple]:
+        month_days = [date.strftime('%m-%d')]
+        if month_days[0] == '02-28' and not calendar.isleap(date.year):
+            month_days.append('02-29')
+        where_clause = f'month_day IN ({", ".join("?" * len(month_days))}) AND date < ?'
+        values = [*month_days, date.isoformat()]
+        if years is not None:
+            where_clause += ' AND date >= ?'
+            values.append(f'{date.year - years:04d}-01-01')
+        query = f'''
+        SELECT date, entry_plain(entry, compressed) FROM {self.entries_table} WHERE {where_clause} ORDER BY date DESC'''
+
+        self.logger.debug('selecting entries on this day with query: %s, and values %s', query, values)
+        with self.cursor() as cursor:
+            return self.execute(cursor, query, values, fetch=True)
+
+    # the days with an entry that fall on a weekday (Monday = 0, like datetime) between two dates, in date order,
+    # [(date, char_count, word_count)]. Like a month, only the counts are loaded, get_entry_text fetches a text
+    def get_weekday_entries(self, weekday: int, first_day: datetime, last_day: datetime) -> list[tuple]:
+        return self._select_entry_dates('weekday = ? AND date BETWEEN ? AND ?',
+                                        (weekday, first_day.isoformat(), last_day.isoformat()))
+
+    # the days with an entry in an ISO week, in date order, [(date, char_count, word_count)]. Week 1 is the week with
+    # the year's first Thursday, as in datetime.date.isocalendar()
+    def get_iso_week_entries(self, year: int, week: int) -> list[tuple]:
+        return self._select_entry_dates('iso_week = ?', (f'{year:04d}-W{week:02d}',))
+
+    # date pattern lookups share this, the condition is on the indexed date columns
+    def _select_entry_dates(self, condition: str, values: tuple) -> list[tuple]:
+        query = f'SELECT date, char_count, word_count FROM {self.entries_table} WHERE {condition} ORDER BY date'
+        self.logger.debug('selecting entry dates with query: %s, and values %s', query, values)
+        with self.cursor() as cursor:
+            return self.execute(cursor, query, values, fetch=True)
+
+    # full text search over the entries, best matches first. Returns [(date, snippet, rank)], where the snippet has the
+    # matched words wrapped in the SEARCH_HIGHLIGHT markers. Plain keywords are matched as whole words, all of them
+    # have to appear. Set raw to pass FTS5 query syntax (OR, NEAR, prefix*) straight through
+    def search_entries(self, keywords: str, first_day: datetime = None, last_day: datetime = None,
+                       limit: int = SEARCH_PAGE_SIZE, offset: int = 0, raw: bool = False) -> list[tuple]:
+        match = keywords if raw else fts_keywords_query(keywords)
+        if not match:
+            return []
+
+        where_clause = f'{self.search_table} MATCH ?'
+        values = [match]
+        if first_day is not None:
+            where_clause += ' AND e.date >= ?'
+            values.append(first_day.isoformat())
+        if last_day is not None:
+            where_clause += ' AND e.date <= ?'
+            values.append(last_day.isoformat())
+        values += [limit, offset]
+
+        open_mark, close_mark = SEARCH_HIGHLIGHT
+        query = f'''
+        SELECT e.date, snippet({self.search_table}, 0, ?, ?, '...', {SEARCH_SNIPPET_TOKENS}), bm25({self.search_table}) AS rank
+        FROM {self.search_table} JOIN {self.entries_table} AS e ON e.id = {self.search_table}.rowid
+        WHERE {where_clause}
+        ORDER BY rank LIMIT ? OFFSET ?'''
+
+        self.logger.debug('searching entries with query: %s, and values %s', query, values)
+        with self.cursor() as cursor:
+            results = self.execute(cursor, query, [open_mark, close_mark] + values, fetch=True)
+        return results
+
+    # brings existing entries in line with the compression settings, compressing long plain entries or, with
+    # compress=False, storing every entry as plain text again. Works in batches of batch_size entries, each its own
+    # transaction with a pause after it, so the app can keep saving while it runs. Stops early once stop() returns True.
+    # Returns the number of entries converted
+    def recompress_entries(self, compress: bool = ENTRY_COMPRESSION, batch_size: int = ENTRY_RECOMPRESS_BATCH,
+                           pause: float = ENTRY_RECOMPRESS_PAUSE, stop=None) -> int:
+        if compress:
+            condition = f'compressed = 0 AND char_count >= {ENTRY_COMPRESS_MIN_CHARS}'
+        else:
+            condition = 'compressed > 0'
+        converted = 0
+        last_id = 0
+        while stop is None or not stop():
+            with self.cursor() as cursor:
+                rows = self.execute(cursor, f'''
+                SELECT id, entry, compressed FROM {self.entries_table} WHERE id > ? AND {condition}
+                ORDER BY id LIMIT ?''', (last_id, batch_size), fetch=True)
+                updates = []
+                for entry_id, value, compressed in rows:
+                    stored, now_compressed = compress_entry(decompress_entry(value, compressed), compress)
+                    if now_compressed != compressed:
+                        updates.append((stored, now_compressed, entry_id))
+                self.execute(cursor, f'UPDATE {self.entries_table} SET entry = ?, compressed = ? WHERE id = ?', updates,
+                             many=True)
+            converted += len(updates)
+            if len(rows) < batch_size:
+                break
+            last_id = rows[-1][0]
+            time.sleep(pause)
+        self.logger.info('Recompressed %s entries', converted)
+        return converted
+
+    # returns (entries, compressed entries, bytes of text, bytes stored) over every entry
+    def compression_stats(self) -> tuple:
+        with self.cursor() as cursor:
+            rows = self.execute(cursor, f'''
+            SELECT count(*), coalesce(sum(compressed != 0), 0),
+            coalesce(sum(CASE WHEN compressed THEN length(CAST(entry_plain(entry, compressed) AS BLOB))
+                         ELSE length(CAST(entry AS BLOB)) END), 0),
+            coalesce(sum(length(CAST(entry AS BLOB))), 0)
+            FROM {self.entries_table}''', fetch=True)
+        return rows[0]
+
+    # rebuilds the full text index from the entries table, for dbs whose index is out of sync or damaged
+    def rebuild_search_index(self):
+        self.logger.info('Rebuilding the entries search index')
+        with self.cursor() as cursor:
+            self.execute(cursor, f"INSERT INTO {self.search_table} ({self.search_table}) VALUES ('rebuild')")
+
+
+# turns plain keywords into an FTS5 query that matches all of them. Every word is quoted, so characters that mean
+# something in FTS5 syntax (quotes, -, :, *) can't cause a query error
+def fts_keywords_query(keywords: str) -> str:
+    terms = ['"' + term.replace('"', '""') + '"' for term in keywords.split()]
+    return ' '.join(terms)
@@ -0,0 +1,405 @@
+"""
+Headless JSON API over the journal db, for front ends other than the Tk window. Run from the journal folder, for example
+    python3 server.py --port 8765
+
+    GET  /months/2024-01                  entry counts and goal states of every day in the month, with an ETag
+    GET  /days/2024-01-05                 the entry text and goal states of a day
+    GET  /days/2024-01-05/on-this-day     the entries from the same day in earlier years, optional years
+    PUT  /days/2024-01-05                 {"entry": "...", "goals": {"1": true}}, either key may be left out
+    GET  /goals                           every goal
+    POST /goals                           {"description": "..."}
+    GET  /goals/stats                     totals and streaks of every goal
+    GET  /search?q=...                    optional from, to (YYYY-MM-DD), limit, offset, and raw=1 for FTS5 syntax
+
+Every request runs on its own thread. Reads borrow a connection from a ConnectionPool, all writes go through one
+WriteBehindQueue and are committed before the response is sent, so the db only ever has one writer. Month responses
+are cached with an ETag, a client that sends it back in If-None-Match gets a 304 while the month is unchanged.
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent import futures
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import logger
+from config import (DATABASE_NAME, SEARCH_PAGE_SIZE, SERVER_BACKLOG, SERVER_HOST, SERVER_MAX_BODY_BYTES,
+                    SERVER_MAX_SEARCH_LIMIT, SERVER_MONTH_CACHE_SIZE, SERVER_POOL_SIZE, SERVER_POOL_TIMEOUT,
+                    SERVER_PORT, SERVER_WRITE_TIMEOUT)
+from controller import JournalData
+from repository import (ConnectionManager, ConnectionPool, EntriesRepository, GoalsRepository, PoolExhausted,
+                        close_shared_connections)
+from writer import WriteBehindQueue
+
+
+# (method, path pattern, handler method name), the pattern's groups are passed to the handler
+ROUTES = [
+    ('GET', re.compile(r'/months/(\d{4}-\d{2})'), 'get_month'),
+    ('GET', re.compile(r'/days/(\d{4}-\d{2}-\d{2})'), 'get_day'),
+    ('PUT', re.compile(r'/days/(\d{4}-\d{2}-\d{2})'), 'put_day'),
+    ('GET', re.compile(r'/days/(\d{4}-\d{2}-\d{2})/on-this-day'), 'get_on_this_day'),
+    ('GET', re.compile(r'/goals'), 'get_goals'),
+    ('POST', re.compile(r'/goals'), 'post_goal'),
+    ('GET', re.compile(r'/goals/stats'), 'get_goal_stats'),
+    ('GET', re.compile(r'/search'), 'search'),
+]
+
+
+class ApiError(Exception):
+    """ Ends a request with an HTTP error status and a JSON {"error": message} body. """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class MonthResponseCache:
+    """ LRU of encoded month responses and their ETags, keyed by (year, month). Each one is kept with the db's
+        data_version it was read at and is only served while the db is still at that version, so a commit from this
+        server or from any other process makes the months be read again. The ETag is a hash of the body, a month that
+        didn't change keeps its ETag after being read again. """
+
+    def __init__(self, max_size: int = SERVER_MONTH_CACHE_SIZE):
+        self.max_size = max_size
+        self.months = OrderedDict()
+        self.lock = threading.Lock()
+
+    # returns (etag, body) if the month was cached at this data_version, else None
+    def get(self, key: tuple, version: int) -> tuple | None:
+        with self.lock:
+            cached = self.months.get(key)
+            if cached is None or cached[0] != version:
+                return None
+            self.months.move_to_end(key)
+            return cached[1], cached[2]
+
+    def put(self, key: tuple, version: int, etag: str, body: bytes):
+        with self.lock:
+            self.months[key] = (version, etag, body)
+            self.months.move_to_end(key)
+            while len(self.months) > self.max_size:
+                self.months.popitem(last=False)
+
+
+class JournalServer(ThreadingHTTPServer):
+    """ Serves the API for one journal db. Holds the read pool, the single writer and the month cache that the
+        request handlers share. """
+
+    daemon_threads = True
+    request_queue_size = SERVER_BACKLOG
+
+    def __init__(self, address: tuple, database_name: str = DATABASE_NAME, pool_size: int = SERVER_POOL_SIZE,
+                 pool_timeout: float = SERVER_POOL_TIMEOUT, write_timeout: float = SERVER_WRITE_TIMEOUT):
+        self.logger = logger.journal_logger()
+        self.database_name = database_name
+        self.pool = ConnectionPool(database_name, pool_size)
+        self.pool_timeout = pool_timeout
+        self.write_timeout = write_timeout
+        # every write is made on this one connection, by the writer thread or under the manager's lock
+        write_manager = ConnectionManager(database_name)
+        self.write_data = JournalData(EntriesRepository(write_manager), GoalsRepository(write_manager))
+        self.writer = WriteBehindQueue(self.write_data)
+        # data_version only changes for commits made on other connections, so this one is kept for reading it
+        self.version_manager = ConnectionManager(database_name)
+        self.months = MonthResponseCache()
+        super().__init__(address, JournalRequestHandler)
+
+    # a JournalData on a pooled connection, for the duration of a 'with' block
+    @contextmanager
+    def reader(self):
+        with self.pool.acquire(self.pool_timeout) as manager:
+            yield JournalData(EntriesRepository(manager), GoalsRepository(manager))
+
+    # a number that changes whenever any connection commits to the db
+    def data_version(self) -> int:
+        with self.version_manager.lock:
+            return self.version_manager.connection.execute('PRAGMA data_version').fetchone()[0]
+
+    # queues a day's save and waits for it to be committed, together with any saves other requests queued meanwhile.
+    # Only this save's own outcome is reported. A failed batch stays queued and is retried, so it is a 503, not a 500
+    def save_day(self, date: datetime.date, entry: str = None, goals: dict = None):
+        saved = self.writer.save(date, entry=entry, goals=goals)
+        self.writer.request_flush()
+        try:
+            saved.result(self.write_timeout)
+        except futures.TimeoutError:
+            raise ApiError(503, f'{date} was not saved within {self.write_timeout}s, it is still queued') from None
+        except Exception as e:
+            raise ApiError(500, f'{date} could not be saved: {e}') from e
+
+    # adds a goal if it doesn't exist yet, returns its id
+    def add_goal(self, description: str) -> int:
+        # the writer thread flushes its batches under the same manager lock, so this can't interleave with them
+        return self.write_data.goal_repo.add_goals([description])[description]
+
+    # stops accepting requests, then writes anything queued and closes every connection
+    def server_close(self):
+        super().server_close()
+        self.writer.close()
+        self.pool.close()
+        self.version_manager.close()
+
+
+class JournalRequestHandler(BaseHTTPRequestHandler):
+    """ Routes a request through ROUTES and answers with JSON. Keep-alive is on, so a client can reuse its connection
+        for many requests. """
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'JournalAPI/1'
+    # headers and body go out as separate writes, with Nagle on every reused connection stalls on a delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    # request lines go to the journal log instead of stderr
+    def log_message(self, format, *args):
+        self.server.logger.debug('API %s %s', self.address_string(), format % args)
+
+    def _dispatch(self, method: str):
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query)
+        try:
+            # the body is always read, so an error answer leaves the connection ready for the next request
+            self.body = self._read_body() if method != 'GET' else None
+            allowed = False
+            for route_method, pattern, name in ROUTES:
+                match = pattern.fullmatch(url.path)
+                if match is None:
+                    continue
+                if route_method == method:
+                    getattr(self, name)(*match.groups())
+                    return
+                allowed = True
+            raise ApiError(405 if allowed else 404, f'{method} {url.path} is not supported')
+        except ApiError as e:
+            self._send_json(e.status, {'error': e.message})
+        except PoolExhausted as e:
+            self._send_json(503, {'error': str(e)})
+        except Exception as e:
+            self.server.logger.exception('API request %s %s failed: %s', method, self.path, e)
+            self._send_json(500, {'error': 'internal error'})
+
+    def _read_body(self):
+        length = self.headers.get('Content-Length')
+        if length is None:
+            raise ApiError(411, 'a Content-Length header is required')
+        try:
+            length = int(length)
+        except ValueError as e:
+            self.close_connection = True
+            raise ApiError(400, f'invalid Content-Length {length}') from e
+        if length > SERVER_MAX_BODY_BYTES:
+            # the body is left unread, so the connection can't be used again
+            self.close_connection = True
+            raise ApiError(413, f'the body is over {SERVER_MAX_BODY_BYTES} bytes')
+        try:
+            return json.loads(self.rfile.read(length) or b'null')
+        except ValueError as e:
+            raise ApiError(400, f'the body is not valid JSON: {e}') from e
+
+    def _send_json(self, status: int, data, headers: dict = None):
+        self._send(status, json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), headers)
+
+    def _send(self, status: int, body: bytes, headers: dict = None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # the month snapshot, from the cache while the db hasn't changed since it was read
+    def get_month(self, month: str):
+        first_day = _parse_date(month + '-01')
+        key = (first_day.year, first_day.month)
+        # read before the month, so a commit made while it's being read makes the cached copy stale straight away
+        version = self.server.data_version()
+        cached = self.server.months.get(key, version)
+        if cached is None:
+            with self.server.reader() as journal_data:
+                snapshot = journal_data.populate_month_data(first_day)
+            body = json.dumps(month_json(month, snapshot), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            cached = (f'"{hashlib.blake2b(body, digest_size=12).hexdigest()}"', body)
+            self.server.months.put(key, version, *cached)
+
+        etag, body = cached
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if etag in _etags(self.headers.get('If-None-Match')):
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self._send(200, body, headers)
+
+    def get_day(self, date: str):
+        self._send_json(200, self._day_json(_parse_date(date)))
+
+    # saves the entry and/or goal states of a day, answers with the day as it is now stored
+    def put_day(self, date: str):
+        date = _parse_date(date)
+        if not isinstance(self.body, dict):
+            raise ApiError(400, 'the body must be a JSON object')
+        entry = self.body.get('entry')
+        if entry is not None and not isinstance(entry, str):
+            raise ApiError(400, 'entry must be a string')
+        goals = self.body.get('goals') or {}
+        if not isinstance(goals, dict):
+            raise ApiError(400, 'goals must be an object of {goal id: state}')
+        try:
+            goals = {int(goal_id): state for goal_id, state in goals.items()}
+        except ValueError as e:
+            raise ApiError(400, f'goal ids must be numbers: {e}') from e
+        # bool() would store the string "false" as a completed goal, so only true/false and 0/1 are accepted
+        if any(state not in (True, False) or type(state) not in (bool, int) for state in goals.values()):
+            raise ApiError(400, 'goal states must be true, false, 0 or 1')
+        goals = {goal_id: bool(state) for goal_id, state in goals.items()}
+        if entry is None and not goals:
+            raise ApiError(400, 'nothing to save, give an entry, goals or both')
+
+        if goals:
+            with self.server.reader() as journal_data:
+                known = {goal_id for goal_id, _ in journal_data.goal_repo.get_goals()}
+            unknown = sorted(set(goals) - known)
+            if unknown:
+                raise ApiError(400, f'unknown goal ids {unknown}')
+        self.server.save_day(date, entry, goals)
+        self._send_json(200, self._day_json(date))
+
+    def get_on_this_day(self, date: str):
+        years = self._query_value('years')
+        try:
+            years = int(years) if years is not None else None
+        except ValueError as e:
+            raise ApiError(400, f'years must be a number: {e}') from e
+        with self.server.reader() as journal_data:
+            entries = journal_data.entry_repo.get_on_this_day(_parse_date(date), years)
+        self._send_json(200, [{'date': entry_date, 'entry': text} for entry_date, text in entries])
+
+    def get_goals(self):
+        with self.server.reader() as journal_data:
+            goals = journal_data.goal_repo.get_goals()
+        self._send_json(200, [{'id': goal_id, 'description': description} for goal_id, description in goals])
+
+    def post_goal(self):
+        description = self.body.get('description') if isinstance(self.body, dict) else None
+        if not isinstance(description, str) or not description.strip():
+            raise ApiError(400, 'description must be a non empty string')
+        goal_id = self.server.add_goal(description)
+        self._send_json(201, {'id': goal_id, 'description': description})
+
+    def get_goal_stats(self):
+        with self.server.reader() as journal_data:
+            stats = journal_data.goal_stats()
+        self._send_json(200, [{'id': goal.goal_id, 'description': goal.description, 'tracked_days': goal.tracked_days,
+                               'completed_days': goal.completed_days, 'completion_ratio': goal.completion_ratio,
+                               'current_streak': goal.current_streak, 'best_streak': goal.best_streak}
+                              for goal in stats.values()])
+
+    def search(self):
+        keywords = self._query_value('q')
+        if not keywords:
+            raise ApiError(400, 'the q parameter is required')
+        first_day = self._query_value('from')
+        last_day = self._query_value('to')
+        try:
+            # a limit below 1 would reach SQLite as LIMIT -1, which is no limit at all
+            limit = max(1, min(int(self._query_value('limit', SEARCH_PAGE_SIZE)), SERVER_MAX_SEARCH_LIMIT))
+            offset = max(int(self._query_value('offset', 0)), 0)
+        except ValueError as e:
+            raise ApiError(400, f'limit and offset must be numbers: {e}') from e
+        first_day = _parse_date(first_day) if first_day else None
+        last_day = _parse_date(last_day) if last_day else None
+        with self.server.reader() as journal_data:
+            try:
+                results = journal_data.entry_repo.search_entries(keywords, first_day, last_day, limit, offset,
+                                                                 raw=self._query_value('raw') == '1')
+            except sqlite3.OperationalError as e:
+                raise ApiError(400, f'invalid search: {e}') from e
+        self._send_json(200, [{'date': date, 'snippet': snippet, 'rank': rank} for date, snippet, rank in results])
+
+    def _query_value(self, name: str, default=None):
+        values = self.query.get(name)
+        return values[0] if values else default
+
+    def _day_json(self, date: datetime.date) -> dict:
+        with self.server.reader() as journal_data:
+            entry = journal_data.entry_repo.get_entry_text(date)
+            states = journal_data.goal_repo.get_goal_states(date)
+        return {'date': date.isoformat(), 'entry': entry,
+                'goals': {str(goal_id): bool(state) for _, _, goal_id, state in states}}
+
+
+# the month snapshot from JournalData.populate_month_data as JSON. Goal descriptions are listed once for the month,
+# days refer to goals by id. Only days with data are included
+def month_json(month: str, snapshot: dict) -> dict:
+    goals = {}
+    days = {}
+    for day_num, (entry_info, states) in sorted(snapshot.items()):
+        char_count, word_count = entry_info if entry_info is not None else (None, None)
+        day_goals = {}
+        for goal_id, (description, state) in states.items():
+            goals[str(goal_id)] = description
+            day_goals[str(goal_id)] = bool(state)
+        days[str(day_num)] = {'char_count': char_count, 'word_count': word_count, 'goals': day_goals}
+    return {'month': month, 'goals': goals, 'days': days}
+
+
+def _parse_date(value: str) -> datetime.date:
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError as e:
+        raise ApiError(400, f'{value} is not a valid YYYY-MM-DD date') from e
+
+
+# the tags listed in an If-None-Match header, weak tags compare like strong ones for a GET
+def _etags(header: str | None) -> set:
+    if not header:
+        return set()
+    return {tag.strip().removeprefix('W/') for tag in header.split(',')}
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Serve the journal as a JSON API')
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    parser.add_argument('--database', default=DATABASE_NAME, help='journal db file')
+    parser.add_argument('--pool-size', type=int, default=SERVER_POOL_SIZE, help='read connections')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logger.configure_logger()
+    server = JournalServer((args.host, args.port), args.database, args.pool_size)
+    host, port = server.server_address[:2]
+    logger.journal_logger().info('Serving %s on http://%s:%s', args.database, host, port)
+    print(f'Serving {args.database} on http://{host}:{port}, Ctrl+C stops')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        close_shared_connections()
+        logger.shutdown_logger()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Startup timing. main.py marks the end of every startup phase, so the time each one took can be logged, or printed with
+    python3 main.py --profile-startup
+Times are counted from when main.py started running, the interpreter's own start up comes before that.
+"""
+
+import time
+
+from config import STARTUP_PAINT_BUDGET_MS
+
+
+class StartupProfile:
+    """ Records when each startup phase ended. The phase named 'first paint' is checked against the budget. """
+
+    PAINT_PHASE = 'first paint'
+
+    def __init__(self, start: float = None, paint_budget_ms: float = STARTUP_PAINT_BUDGET_MS):
+        self.start = start if start is not None else time.perf_counter()
+        self.paint_budget_ms = paint_budget_ms
+        # [(phase, perf_counter when it ended)]
+        self.marks = []
+
+    # records that a phase has just ended, or ended at the given perf_counter time
+    def mark(self, phase: str, at: float = None):
+        self.marks.append((phase, at if at is not None else time.perf_counter()))
+
+    # milliseconds from the start until the phase ended, None if it hasn't been marked
+    def elapsed_ms(self, phase: str) -> float | None:
+        for name, ended in self.marks:
+            if name == phase:
+                return (ended - self.start) * 1000
+        return None
+
+    # [(phase, milliseconds the phase took, milliseconds since the start)]
+    def phases(self) -> list[tuple]:
+        rows = []
+        previous = self.start
+        for name, ended in self.marks:
+            rows.append((name, (ended - previous) * 1000, (ended - self.start) * 1000))
+            previous = ended
+        return rows
+
+    # True unless the window was painted later than the budget allows
+    def within_budget(self) -> bool:
+        paint_ms = self.elapsed_ms(self.PAINT_PHASE)
+        return paint_ms is None or paint_ms <= self.paint_budget_ms
+
+    # the phases as a table, with the first paint compared to the budget
+    def report(self) -> str:
+        lines = [f'{"phase":<20} {"ms":>9} {"total ms":>9}']
+        lines += [f'{name:<20} {took:>9.1f} {total:>9.1f}' for name, took, total in self.phases()]
+        paint_ms = self.elapsed_ms(self.PAINT_PHASE)
+        if paint_ms is not None:
+            verdict = 'within' if self.within_budget() else 'OVER'
+            lines.append(f'first paint {paint_ms:.1f} ms, {verdict} the {self.paint_budget_ms} ms budget')
+        return '\n'.join(lines)
@@ -0,0 +1,226 @@
+"""
+Streaming import and export of whole journals, as JSON lines or CSV. Both directions work on generators, exports read
+the tables a page at a time and imports write a chunk of days per transaction, so memory use stays the same however
+long the journal is. Run through manage.py, for example
+    python3 manage.py export backup.jsonl
+    python3 manage.py import backup.jsonl --resume
+
+JSON lines hold one object per line. Goals come first as {"type": "goal", "description": ...}, then one object per day,
+{"type": "day", "date": "2024-01-01", "entry": ..., "goals": {description: state}}. Lines without a type are days, so
+other diary tools only need to write {"date": ..., "entry": ...}.
+CSV has a date and an entry column, then one column per goal named by its description, holding 1, 0 or nothing. An
+empty entry cell means the day has no entry.
+Goals are matched by description, importing into a journal that already has data adds to it and overwrites the days
+that are in the file.
+"""
+
+import csv
+import datetime
+import json
+import os
+import pathlib
+
+import logger
+from config import TRANSFER_CHUNK_SIZE, TRANSFER_PAGE_SIZE
+
+
+# the supported file formats
+FORMATS = ('jsonl', 'csv')
+
+
+class TransferError(Exception):
+    """ Raised for a file that can't be imported, with the record number it stopped at. """
+
+
+# jsonl unless the path ends in .csv
+def guess_format(path) -> str:
+    return 'csv' if pathlib.Path(path).suffix.lower() == '.csv' else 'jsonl'
+
+
+# the checkpoint of a resumable import is kept next to the file being imported
+def checkpoint_path(path) -> pathlib.Path:
+    path = pathlib.Path(path)
+    return path.with_name(path.name + '.progress')
+
+
+# yields (date, entry, {goal_id: state}) for every day that has an entry or goal states, in date order. Entries and
+# goal states are both read in date order, so the two streams are merged a day at a time
+def iter_days(journal_data, page_size: int = TRANSFER_PAGE_SIZE):
+    entries = (row for page in journal_data.entry_repo.iter_entries(page_size) for row in page)
+    states = (row for page in journal_data.goal_repo.iter_goal_states(page_size) for row in page)
+    entry = next(entries, None)
+    state = next(states, None)
+    while entry is not None or state is not None:
+        date = min(row[0] for row in (entry, state) if row is not None)
+        text = None
+        if entry is not None and entry[0] == date:
+            text = entry[1]
+            entry = next(entries, None)
+        goals = {}
+        while state is not None and state[0] == date:
+            goals[state[1]] = state[2]
+            state = next(states, None)
+        yield date, text, goals
+
+
+# writes the whole journal to path. progress is called with the number of days written so far, every page_size days.
+# Returns the number of days written
+def export_journal(journal_data, path, file_format: str = None, page_size: int = TRANSFER_PAGE_SIZE,
+                   progress=None) -> int:
+    log = logger.journal_logger()
+    file_format = file_format or guess_format(path)
+    goals = {goal_id: description for page in journal_data.goal_repo.iter_goals(page_size)
+             for goal_id, description in page}
+    log.info('Exporting the journal to %s as %s', path, file_format)
+
+    count = 0
+    newline = '' if file_format == 'csv' else None
+    with open(path, 'w', encoding='utf-8', newline=newline) as file:
+        if file_format == 'csv':
+            goal_ids = list(goals)
+            writer = csv.writer(file)
+            writer.writerow(['date', 'entry', *(goals[goal_id] for goal_id in goal_ids)])
+        else:
+            for description in goals.values():
+                file.write(json.dumps({'type': 'goal', 'description': description}, ensure_ascii=False) + '\n')
+
+        for date, entry, states in iter_days(journal_data, page_size):
+            if file_format == 'csv':
+                writer.writerow([date, entry or '', *(_csv_state(states.get(goal_id)) for goal_id in goal_ids)])
+            else:
+                record = {'type': 'day', 'date': date, 'entry': entry,
+                          'goals': {goals[goal_id]: bool(state) for goal_id, state in states.items()}}
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            count += 1
+            if progress is not None and count % page_size == 0:
+                progress(count)
+
+    if progress is not None:
+        progress(count)
+    log.info('Exported %s days to %s', count, path)
+    return count
+
+
+# yields (record_number, record) for every record in the file, numbered from 1. A record is ('goal', description) or
+# ('day', date, entry, {description: state}). Records up to skip are counted but not parsed
+def read_records(path, file_format: str = None, skip: int = 0):
+    file_format = file_format or guess_format(path)
+    with open(path, encoding='utf-8', newline='' if file_format == 'csv' else None) as file:
+        if file_format == 'csv':
+            yield from _read_csv(file, skip)
+        else:
+            yield from _read_jsonl(file, skip)
+
+
+def _read_jsonl(file, skip: int):
+    number = 0
+    for line in file:
+        if not line.strip():
+            continue
+        number += 1
+        if number <= skip:
+            continue
+        try:
+            data = json.loads(line)
+            if data.get('type', 'day') == 'goal':
+                yield number, ('goal', str(data['description']))
+            else:
+                yield number, ('day', _parse_date(data['date']), data.get('entry'), dict(data.get('goals') or {}))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            raise TransferError(f'{file.name} record {number}: {e!r}') from e
+
+
+def _read_csv(file, skip: int):
+    reader = csv.reader(file)
+    header = next(reader, None)
+    if header is None:
+        return
+    if header[:2] != ['date', 'entry']:
+        raise TransferError(f'{file.name}: the first columns must be date and entry, not {header[:2]}')
+    goal_columns = header[2:]
+    if skip == 0:
+        for description in goal_columns:
+            yield 0, ('goal', description)
+
+    for number, row in enumerate(reader, 1):
+        if number <= skip:
+            continue
+        try:
+            states = {description: value.strip() not in ('0', 'false', 'False')
+                      for description, value in zip(goal_columns, row[2:]) if value.strip()}
+            yield number, ('day', _parse_date(row[0]), row[1] or None, states)
+        except (ValueError, IndexError) as e:
+            raise TransferError(f'{file.name} record {number}: {e!r}') from e
+
+
+def _parse_date(value) -> datetime.date:
+    return datetime.date.fromisoformat(value)
+
+
+def _csv_state(state) -> str:
+    return '' if state is None else str(int(bool(state)))
+
+
+# imports a file written by export_journal, or by another tool in the same format. Days are written chunk_size at a
+# time, each chunk in one transaction. With resume, the records a checkpoint says were already written are skipped.
+# progress is called with the number of records written so far after every chunk. Returns the number of records
+def import_journal(journal_data, path, file_format: str = None, chunk_size: int = TRANSFER_CHUNK_SIZE,
+                   resume: bool = False, progress=None) -> int:
+    log = logger.journal_logger()
+    file_format = file_format or guess_format(path)
+    checkpoint = checkpoint_path(path)
+    source = _source_signature(path)
+
+    done = 0
+    if resume and checkpoint.exists():
+        saved = json.loads(checkpoint.read_text())
+        if saved['source'] != source:
+            raise TransferError(f'{path} changed since the interrupted import, start it again without resume')
+        done = saved['records']
+        log.info('Resuming the import of %s after %s records', path, done)
+    else:
+        log.info('Importing %s as %s', path, file_format)
+
+    goal_ids = {}
+    days = {}
+    last_number = done
+    for number, record in read_records(path, file_format, skip=done):
+        if record[0] == 'goal':
+            goal_ids.update(journal_data.goal_repo.add_goals([record[1]]))
+            continue
+
+        _, date, entry, states = record
+        unknown = [description for description in states if description not in goal_ids]
+        if unknown:
+            goal_ids.update(journal_data.goal_repo.add_goals(unknown))
+        saved_entry, saved_goals = days.get(date, (None, {}))
+        days[date] = (entry if entry is not None else saved_entry,
+                      {**saved_goals, **{goal_ids[description]: bool(state) for description, state in states.items()}})
+        last_number = number
+
+        if len(days) >= chunk_size:
+            _write_chunk(journal_data, days, checkpoint, source, last_number, progress)
+            days = {}
+
+    if days:
+        _write_chunk(journal_data, days, checkpoint, source, last_number, progress)
+    checkpoint.unlink(missing_ok=True)
+    log.info('Imported %s records from %s', last_number, path)
+    return last_number
+
+
+# writes one chunk of days in a single transaction, then records how far the import got. Imported texts don't add to
+# the entry history
+def _write_chunk(journal_data, days: dict, checkpoint: pathlib.Path, source: dict, records: int, progress):
+    journal_data.save_days_data(days, revisions=False)
+    temporary = checkpoint.with_name(checkpoint.name + '.tmp')
+    temporary.write_text(json.dumps({'source': source, 'records': records}))
+    os.replace(temporary, checkpoint)
+    if progress is not None:
+        progress(records)
+
+
+# identifies the file being imported, a resume is refused if it changed
+def _source_signature(path) -> dict:
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
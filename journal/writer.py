@@ -0,0 +1,194 @@
+"""
+Write-behind queue for day data. Saves are queued by the UI thread and written by a single background thread with its
+own db connection, so a slow disk never stalls typing.
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+
+import logger
+from config import WRITE_FLUSH_INTERVAL, WRITE_BATCH_SIZE
+
+
+class WriteBehindQueue:
+    """ Coalesces pending day saves per date and writes them in batches, on a timer or once WRITE_BATCH_SIZE days are
+        waiting. Takes a JournalData whose repositories are only used by the writer thread. """
+
+    def __init__(self, journal_data, on_error=None, flush_interval: float = WRITE_FLUSH_INTERVAL,
+                 batch_size: int = WRITE_BATCH_SIZE):
+        self.logger = logger.journal_logger()
+        self.journal_data = journal_data
+        # called on the writer thread as on_error(exception, dates) when a batch fails to save
+        self.on_error = on_error
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self.condition = threading.Condition()
+        # {date: [entry, {goal_id: state}]}, only the latest entry text for a date is kept
+        self.pending = {}
+        # the batch the writer thread is saving right now, still visible to readers until it is committed
+        self.in_flight = {}
+        # {date: [Future]} of the saves waiting in pending, handed to the writer thread together with their batch
+        self.waiting = {}
+        self.queued_count = 0
+        self.written_count = 0
+        self.flush_requested = False
+        self.closed = False
+        self.last_error = None
+        self.error_count = 0
+
+        self.thread = threading.Thread(target=self._run, name='journal-writer', daemon=True)
+        self.thread.start()
+
+    # queues the entry and/or goal states for a date, replacing any entry text that is still waiting for that date.
+    # Returns a Future that is resolved once this save is committed. A failed batch is retried, so the future only
+    # fails if the save is dropped because the queue was closed
+    def save(self, date, entry: str = None, goals: dict = None) -> Future:
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise RuntimeError('Write-behind queue is closed')
+            was_empty = not self.pending
+            day = self.pending.setdefault(date, [None, {}])
+            if entry is not None:
+                day[0] = entry
+            if goals:
+                day[1].update(goals)
+            self.waiting.setdefault(date, []).append(future)
+            self.queued_count += 1
+            # wake the writer to start the flush timer, or to write a full batch straight away
+            if was_empty or len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+        return future
+
+    # asks the writer thread to write what is pending now instead of when the flush timer runs out, without waiting
+    def request_flush(self):
+        with self.condition:
+            self.flush_requested = True
+            self.condition.notify_all()
+
+    # returns the unsaved data for the dates the predicate accepts, {date: (entry, goals)}. Months loaded from the db
+    # while saves are pending use this so they don't show older text
+    def unsaved(self, predicate=None) -> dict:
+        with self.condition:
+            days = {}
+            for source in (self.in_flight, self.pending):
+                for date, (entry, goals) in source.items():
+                    if predicate is not None and not predicate(date):
+                        continue
+                    saved_entry, saved_goals = days.get(date, (None, {}))
+                    days[date] = (entry if entry is not None else saved_entry, {**saved_goals, **goals})
+            return days
+
+    # blocks until everything queued before the call is written. Returns False if the timeout ran out or a save failed
+    def flush(self, timeout: float = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            target = self.queued_count
+            errors = self.error_count
+            self.flush_requested = True
+            self.condition.notify_all()
+            while self.written_count < target:
+                if self.error_count != errors or not self.thread.is_alive():
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return self.last_error is None
+
+    # writes everything that is pending and stops the writer thread, to be called when the window closes. Waits up to
+    # timeout for the writer to finish, calling it again waits again
+    def close(self, timeout: float = None):
+        with self.condition:
+            if not self.closed:
+                self.closed = True
+                self.condition.notify_all()
+        self.thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self._wait_for_batch()
+                if not self.pending and self.closed:
+                    break
+                batch, self.pending = self.pending, {}
+                waiting, self.waiting = self.waiting, {}
+                self.in_flight = batch
+                target = self.queued_count
+                self.flush_requested = False
+
+            error = self._write(batch) if batch else None
+            # the futures to resolve once the condition is released, with None for the saves that were committed
+            resolved = None
+
+            with self.condition:
+                self.in_flight = {}
+                if error is None:
+                    self.written_count = target
+                    self.last_error = None
+                    resolved = None, waiting
+                else:
+                    self.last_error = error
+                    self.error_count += 1
+                    # put the batch back under anything queued since, unless the app is closing, then it's lost
+                    if not self.closed:
+                        for date, day in batch.items():
+                            newer = self.pending.get(date)
+                            if newer is None:
+                                self.pending[date] = day
+                            else:
+                                newer[1] = {**day[1], **newer[1]}
+                                if newer[0] is None:
+                                    newer[0] = day[0]
+                        for date, futures in waiting.items():
+                            self.waiting.setdefault(date, []).extend(futures)
+                    else:
+                        self.written_count = target
+                        resolved = error, waiting
+                self.condition.notify_all()
+
+            if resolved is not None:
+                error, waiting = resolved
+                for futures in waiting.values():
+                    for future in futures:
+                        if error is None:
+                            future.set_result(None)
+                        else:
+                            future.set_exception(error)
+
+        self.journal_data.entry_repo.manager.close()
+
+    # waits until there is a reason to write: a full batch, a flush, closing, or pending data older than the interval.
+    # Called with the condition held
+    def _wait_for_batch(self):
+        deadline = None
+        while True:
+            if self.closed or self.flush_requested or len(self.pending) >= self.batch_size:
+                return
+            if self.pending:
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self.condition.wait(remaining)
+            else:
+                deadline = None
+                self.condition.wait()
+
+    # saves one batch in a single transaction, returns the exception if it failed
+    def _write(self, batch: dict) -> Exception | None:
+        try:
+            self.journal_data.save_days_data({date: (entry, goals) for date, (entry, goals) in batch.items()})
+            self.logger.debug('Write-behind queue saved %s days', len(batch))
+            return None
+        except Exception as e:
+            self.logger.exception('Write-behind queue failed to save %s days: %s', len(batch), e)
+            if self.on_error is not None:
+                try:
+                    self.on_error(e, sorted(batch))
+                except Exception:
+                    self.logger.exception('Save error callback failed')
+            return e